@@ -1,6 +1,7 @@
+import asyncio
 import os
 import pytest
-from vsslite import VSSLiteClient
+from vsslite import VSSLiteClient, LangChainVSSLiteClient
 
 API_KEY = os.environ.get("OPENAI_APIKEY")
 
@@ -232,3 +233,58 @@ def test_bulk_csv():
     assert s5[0]["body"] == "up:Red pandas are smaller than pandas, but when it comes to cuteness, there is no \"lesser\" about them."
     s6 = vss.search("food")
     assert s6[0]["body"] == "up:There is no difference between \"Ohagi\" and \"Botamochi\" themselves; they are used interchangeably depending on the season."
+
+
+@pytest.mark.asyncio
+async def test_asearch_many():
+    vss = VSSLiteClient()
+    await vss.adelete_all()
+
+    await vss.aimport_file("tests/data/sample.json")
+
+    results = await vss.asearch_many(["fish", "animal", "food"])
+    assert results[0][0]["body"] == "The difference between eel and conger eel is that eel is more expensive."
+    assert results[1][0]["body"] == "Red pandas are smaller than pandas, but when it comes to cuteness, there is no \"lesser\" about them."
+    assert results[2][0]["body"] == "There is no difference between \"Ohagi\" and \"Botamochi\" themselves; they are used interchangeably depending on the season."
+
+
+@pytest.mark.asyncio
+async def test_close_in_running_loop():
+    for vss in [VSSLiteClient(), LangChainVSSLiteClient()]:
+        session = vss.get_session()
+
+        # Sync close doesn't wait for this loop, which is blocked until it returns
+        vss.close()
+        assert vss.sessions.get(asyncio.get_running_loop()) is None
+        for _ in range(10):
+            if session.closed:
+                break
+            await asyncio.sleep(0.1)
+        assert session.closed
+
+        # New session is made on the next call
+        assert vss.get_session() is not session
+        await vss.aclose()
+
+
+@pytest.mark.asyncio
+async def test_aimport_file_missing_key(tmp_path, monkeypatch):
+    path = tmp_path / "records.jsonl"
+    path.write_text('{"body": "eel"}\n{"title": "panda"}\n{"body": "ohagi"}\n')
+
+    # Records without the body are reported and the others are added
+    vss = VSSLiteClient()
+    async def aadd_many(bodies, data_list=None, namespace="default"):
+        return [len(b) for b in bodies]
+    monkeypatch.setattr(vss, "aadd_many", aadd_many)
+    ret = await vss.aimport_file(str(path))
+    assert ret["ids"] == [3, 5]
+    assert ret["errors"] == [{"message": "'body' not found", "record": {"title": "panda"}}]
+
+    lcvss = LangChainVSSLiteClient()
+    async def aadd(documents, namespace="default"):
+        return [d.page_content for d in documents]
+    monkeypatch.setattr(lcvss, "aadd", aadd)
+    ret = await lcvss.aimport_file(str(path), content_key="body")
+    assert ret["ids"] == ["eel", "ohagi"]
+    assert ret["errors"] == [{"message": "'body' not found", "record": {"title": "panda"}}]
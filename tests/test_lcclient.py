@@ -1,6 +1,7 @@
+import asyncio
 import os
 import pytest
-from vsslite.lcclient import LangChainVSSLiteClient as VSSClient
+from vsslite.lcclient import LangChainVSSLiteClient as VSSClient, Document
 
 API_KEY = os.environ.get("OPENAI_APIKEY")
 
@@ -166,3 +167,117 @@ def test_bulk_csv():
     assert r2["documents"][0]["page_content"] == "Red pandas are smaller than pandas, but when it comes to cuteness, there is no \"lesser\" about them."
     r3 = vss.get(ids[2])
     assert r3["documents"][0]["page_content"] == "There is no difference between \"Ohagi\" and \"Botamochi\" themselves; they are used interchangeably depending on the season."
+
+
+async def wait_job(vss: VSSClient, job_id: str) -> dict:
+    while True:
+        job = await vss.aget_job(job_id)
+        if job["status"] in ("completed", "failed"):
+            return job
+        await asyncio.sleep(0.5)
+
+
+@pytest.mark.asyncio
+async def test_aupload_diff(tmp_path):
+    vss = VSSClient()
+    await vss.adelete_all()
+
+    paragraphs = [f"{name} " * 60 for name in ["Eel", "Panda", "Ohagi"]]
+    path = tmp_path / "diff.txt"
+    path.write_text("\n\n".join(paragraphs))
+
+    job = await wait_job(vss, await vss.aupload_background(str(path)))
+    assert job["status"] == "completed"
+    assert job["chunk_count"] == 3
+    assert job["written_count"] == 3
+    assert job["unchanged_count"] == 0
+
+    # Unchanged chunks are not embedded again
+    job = await wait_job(vss, await vss.aupload_background(str(path)))
+    assert job["unchanged_count"] == 3
+    assert job["written_count"] == 0
+    assert job["deleted_count"] == 0
+
+    # Changed chunk is replaced and vanished chunk is deleted
+    path.write_text("\n\n".join([paragraphs[0], "Botamochi " * 50]))
+    job = await wait_job(vss, await vss.aupload_background(str(path)))
+    assert job["unchanged_count"] == 1
+    assert job["written_count"] == 1
+    assert job["deleted_count"] == 2
+    assert len((await vss.aget_all())["ids"]) == 2
+
+    # Synchronous upload returns the ids of all chunks of the source
+    ids = await vss.aupload(str(path))
+    assert sorted(ids) == sorted(job["ids"])
+
+
+@pytest.mark.asyncio
+async def test_aiter_all():
+    vss = VSSClient()
+    await vss.adelete_all()
+
+    ids = await vss.aadd([Document(page_content=f"Eel recipe number {i}", metadata={"source": "inline"}) for i in range(25)])
+
+    # All documents are fetched across pages without duplicates
+    documents = [d async for d in vss.aiter_all(page_size=10)]
+    assert len(documents) == 25
+    assert sorted(d["id"] for d in documents) == sorted(ids)
+
+    all_documents = await vss.aget_all(page_size=7)
+    assert sorted(all_documents["ids"]) == sorted(ids)
+    assert all(d["page_content"].startswith("Eel recipe number") for d in all_documents["documents"])
+
+
+@pytest.mark.asyncio
+async def test_asearch_where_mmr():
+    vss = VSSClient()
+    await vss.adelete_all()
+
+    await vss.aadd([
+        Document(page_content="The difference between eel and conger eel is that eel is more expensive.", metadata={"source": "fish"}),
+        Document(page_content="The difference between eel and conger eel is that eel is more expensive!", metadata={"source": "fish"}),
+        Document(page_content="Conger eel is cheaper than eel.", metadata={"source": "fish"}),
+        Document(page_content="Red pandas are smaller than pandas, but when it comes to cuteness, there is no \"lesser\" about them.", metadata={"source": "animal"}),
+    ])
+
+    # Results are filtered by metadata
+    s1 = await vss.asearch("eel", count=4, where={"source": "animal"})
+    assert len(s1) == 1
+    assert s1[0]["metadata"]["source"] == "animal"
+
+    # MMR prefers diverse results to near duplicates
+    s2 = await vss.asearch("eel", count=2, where={"source": "fish"}, mmr=True, fetch_k=3, lambda_mult=0.1)
+    assert len(s2) == 2
+    assert "Conger eel is cheaper than eel." in [r["page_content"] for r in s2]
+
+
+@pytest.mark.asyncio
+async def test_aadd_duplicates():
+    vss = VSSClient()
+    await vss.adelete_all()
+
+    # The server started without dedup stores duplicates as they are
+    body = "The difference between eel and conger eel is that eel is more expensive."
+    ids = await vss.aadd([Document(page_content=body, metadata={"source": "inline"}) for _ in range(3)])
+    assert len(set(ids)) == 3
+    assert None not in ids
+
+    ret = await vss.aimport_file("tests/data/sample.json", content_key="body")
+    assert ret["errors"] == []
+    assert len(ret["ids"]) == 3
+    assert ret["duplicates"] == []
+
+
+@pytest.mark.asyncio
+async def test_aimport_file_duplicates(monkeypatch):
+    vss = VSSClient()
+
+    # Documents skipped by the server are reported as duplicates by their index in the file
+    async def aadd(documents, namespace="default"):
+        return [None if d.page_content.startswith("Red pandas") else d.page_content[:3] for d in documents]
+    monkeypatch.setattr(vss, "aadd", aadd)
+
+    ret = await vss.aimport_file("tests/data/sample.json", content_key="body")
+    assert ret["ids"] == ["The", "The"]
+    assert ret["duplicates"] == [1]
+    assert ret["errors"] == []
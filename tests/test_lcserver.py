@@ -0,0 +1,203 @@
+import asyncio
+import numpy as np
+import pytest
+from langchain.schema import Document as LDocument
+from vsslite.lcserver import VectorStoreRegistry, ChromaExecutor, ChunkDeduplicator, IngestionQueue
+
+
+class FakeSystem:
+    def __init__(self):
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+
+class FakeClient:
+    def __init__(self):
+        self._system = FakeSystem()
+
+
+class FakeCollection:
+    def __init__(self):
+        self.items = {}
+
+    def count(self) -> int:
+        return len(self.items)
+
+    @staticmethod
+    def match(metadata: dict, where: dict) -> bool:
+        for k, v in (where or {}).items():
+            if isinstance(v, dict):
+                if metadata.get(k) not in v["$in"]:
+                    return False
+            elif metadata.get(k) != v:
+                return False
+        return True
+
+    def get(self, where: dict = None, include: list = None) -> dict:
+        ids = [id for id, (_, metadata, _) in self.items.items() if self.match(metadata, where)]
+        return {"ids": ids, "metadatas": [self.items[id][1] for id in ids]}
+
+    def query(self, query_embeddings: list, n_results: int = 1, include: list = None) -> dict:
+        ret = {"ids": [], "distances": []}
+        for q in query_embeddings:
+            hits = sorted((float(np.sum((np.asarray(e) - np.asarray(q)) ** 2)), id) for id, (e, _, _) in self.items.items())[:n_results]
+            ret["ids"].append([id for _, id in hits])
+            ret["distances"].append([d for d, _ in hits])
+        return ret
+
+    def upsert(self, ids: list, embeddings: list, metadatas: list, documents: list):
+        for id, e, m, d in zip(ids, embeddings, metadatas, documents):
+            self.items[id] = (e, dict(m), d)
+
+    def delete(self, ids: list):
+        for id in ids:
+            self.items.pop(id, None)
+
+
+class FakeStore:
+    def __init__(self, namespace: str, collection: FakeCollection = None):
+        self.namespace = namespace
+        self._client = FakeClient()
+        self._collection = collection or FakeCollection()
+
+    @property
+    def closed(self) -> bool:
+        return self._client._system.stopped
+
+
+class FakeVectorStoreRegistry(VectorStoreRegistry):
+    def open(self, namespace: str) -> FakeStore:
+        return FakeStore(namespace)
+
+
+def test_vector_store_registry():
+    registry = FakeVectorStoreRegistry("tests/data/vectorstore", None, max_size=2)
+
+    # Stores are reused while cached
+    with registry.use("a") as a:
+        pass
+    with registry.use("a") as a2:
+        assert a2 is a
+    with registry.use("b") as b:
+        pass
+
+    # Idle store is closed when evicted
+    with registry.use("c") as c:
+        pass
+    assert a.closed
+    assert not b.closed and not c.closed
+
+    # Store in use is closed after it is released
+    with registry.use("b") as b2:
+        assert b2 is b
+        with registry.use("a") as a3:
+            with registry.use("d"):
+                assert not b.closed
+        assert not b.closed
+    assert b.closed
+    assert not a3.closed
+
+    # Discarded store is reopened on the next use
+    registry.discard("a")
+    assert a3.closed
+    with registry.use("a") as a4:
+        assert a4 is not a3
+
+    stats = registry.get_stats()
+    assert stats["hits"] == 2
+    assert stats["opens"] == 6
+    assert stats["evictions"] == 3
+    assert stats["in_use"] == 0
+    assert stats["size"] == 2
+
+    d = registry.items["d"]
+    registry.close_all()
+    assert a4.closed and d.closed
+    assert registry.get_stats()["size"] == 0
+
+
+def test_vector_store_registry_no_cache():
+    registry = FakeVectorStoreRegistry("tests/data/vectorstore", None, max_size=0)
+    with registry.use("a") as a:
+        with registry.use("a") as a2:
+            assert a2 is not a
+        assert a2.closed
+        assert not a.closed
+    assert a.closed
+    assert registry.get_stats()["size"] == 0
+
+
+class FakeEmbeddings:
+    # Texts with the same first letter are near each other
+    def embed_documents(self, texts: list) -> list:
+        return [[float(ord(t[0])), 0.01 * (ord(t[-1]) % 10)] for t in texts]
+
+
+class SharedVectorStoreRegistry(VectorStoreRegistry):
+    def __init__(self):
+        super().__init__("tests/data/vectorstore", None)
+        self.collections = {}
+
+    def open(self, namespace: str) -> FakeStore:
+        return FakeStore(namespace, self.collections.setdefault(namespace, FakeCollection()))
+
+
+@pytest.mark.asyncio
+async def test_ingestion_dedup():
+    executor = ChromaExecutor(2, 1)
+    registry = SharedVectorStoreRegistry()
+    queue = IngestionQueue(executor, registry, FakeEmbeddings(), worker_count=2, batch_size=2, max_in_flight_batches=4, deduplicator=ChunkDeduplicator("near"))
+    queue.count_tokens = lambda text: 1
+
+    def make_loader(filename: str, texts: list):
+        async def load():
+            return [LDocument(page_content=t, metadata={"source": filename}) for t in texts]
+        return load
+
+    try:
+        # Near duplicate headers in different batches are stored once
+        job = queue.submit("default", "a.txt", make_loader("a.txt", ["Header 1", "Apple", "Header 2", "Banana", "Header 3", "Cherry"]))
+        job = await queue.wait(job["id"])
+        assert job["status"] == "completed"
+        assert job["written_count"] == 4
+        assert job["duplicate_count"] == 2
+        assert sorted(d for _, _, d in registry.collections["default"].items.values()) == ["Apple", "Banana", "Cherry", "Header 1"]
+
+        # Concurrent uploads of the same chunks store them once
+        jobs = [queue.submit("other", f"{i}.txt", make_loader(f"{i}.txt", ["Eel", "Panda", "Ohagi"])) for i in range(2)]
+        jobs = [await queue.wait(j["id"]) for j in jobs]
+        assert sum(j["written_count"] for j in jobs) == 3
+        assert sum(j["duplicate_count"] for j in jobs) == 3
+        assert registry.collections["other"].count() == 3
+
+    finally:
+        await queue.stop()
+        executor.shutdown()
+
+
+def test_chunk_deduplicator():
+    with pytest.raises(ValueError):
+        ChunkDeduplicator("fuzzy")
+
+    collection = FakeCollection()
+    collection.upsert(["s1"], [[0.0, 0.0]], [{"content_hash": ChunkDeduplicator.make_content_hash("Eel  is fish")}], ["Eel  is fish"])
+
+    # Normalized contents stored or preceding are duplicates
+    deduplicator = ChunkDeduplicator("exact")
+    documents = [LDocument(page_content=t, metadata={}) for t in ["eel is FISH", "Panda", "panda", "Ohagi"]]
+    assert deduplicator.filter_exact(collection, documents) == [1, 3]
+    assert documents[0].metadata["content_hash"] == collection.items["s1"][1]["content_hash"]
+    assert deduplicator.filter_exact(collection, documents, excluded_ids=["s1"]) == [0, 1, 3]
+
+    # Exact mode doesn't filter by embeddings
+    embeddings = [[0.1, 0.0], [1.0, 0.0], [1.1, 0.0], [2.0, 0.0]]
+    assert deduplicator.filter_near(collection, embeddings) == [0, 1, 2, 3]
+
+    # Embeddings within the threshold of stored or preceding ones are duplicates
+    deduplicator = ChunkDeduplicator("near", near_threshold=0.05)
+    assert deduplicator.filter_near(collection, embeddings) == [1, 3]
+    assert deduplicator.filter_near(collection, embeddings, excluded_ids=["s1"]) == [0, 1, 3]
+    assert deduplicator.filter_near(FakeCollection(), embeddings) == [0, 1, 3]
+    assert deduplicator.filter_near(collection, []) == []
@@ -0,0 +1,29 @@
+import pytest
+from vsslite.records import adetect_format, aiter_records, aiter_json_records
+
+
+@pytest.mark.asyncio
+async def test_aiter_records():
+    json_records = [r async for r in aiter_records("tests/data/sample.json")]
+    csv_records = [r async for r in aiter_records("tests/data/sample.csv")]
+    jsonl_records = [r async for r in aiter_records("tests/data/sample.jsonl")]
+
+    assert len(json_records) == 3
+    assert json_records == csv_records == jsonl_records
+    assert json_records[1]["body"] == "Red pandas are smaller than pandas, but when it comes to cuteness, there is no \"lesser\" about them."
+
+    # Records are decoded across chunk boundaries
+    assert [r async for r in aiter_json_records("tests/data/sample.json", chunk_size=16)] == json_records
+
+
+@pytest.mark.asyncio
+async def test_adetect_format(tmp_path):
+    assert await adetect_format("tests/data/sample.jsonl") == "jsonl"
+
+    path = tmp_path / "records.txt"
+    path.write_text('{"body": "eel"}\n{"body": "panda"}\n')
+    assert await adetect_format(str(path)) == "jsonl"
+    path.write_text('{\n  "records": [{"body": "eel"}]\n}\n')
+    assert await adetect_format(str(path)) == "json"
+    path.write_text('body\neel\n')
+    assert await adetect_format(str(path)) == "csv"
@@ -0,0 +1,166 @@
+import asyncio
+import pytest
+import aiohttp
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+from vsslite.requester import ReplicaRequester
+
+
+def response_error(status: int) -> aiohttp.ClientResponseError:
+    request_info = aiohttp.RequestInfo(URL("http://127.0.0.1:8000"), "GET", CIMultiDictProxy(CIMultiDict()), URL("http://127.0.0.1:8000"))
+    return aiohttp.ClientResponseError(request_info, (), status=status)
+
+
+@pytest.mark.asyncio
+async def test_retry():
+    requester = ReplicaRequester(["http://a"], retry_count=2, backoff_base=0.01)
+    calls = []
+
+    async def send(base_url: str, timeout: float):
+        calls.append(base_url)
+        if len(calls) < 3:
+            raise aiohttp.ClientConnectionError()
+        return "ok"
+
+    assert await requester.arequest(send, 5.0) == "ok"
+    assert len(calls) == 3
+
+    # Gives up after retry_count retries
+    calls.clear()
+    async def always_fail(base_url: str, timeout: float):
+        calls.append(base_url)
+        raise response_error(503)
+
+    with pytest.raises(aiohttp.ClientResponseError):
+        await requester.arequest(always_fail, 5.0)
+    assert len(calls) == 3
+
+    # Client errors and others are not retried
+    for ex in [response_error(400), ValueError()]:
+        calls.clear()
+        async def fail(base_url: str, timeout: float):
+            calls.append(base_url)
+            raise ex
+
+        with pytest.raises(type(ex)):
+            await requester.arequest(fail, 5.0)
+        assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_backoff(monkeypatch):
+    monkeypatch.setattr("vsslite.requester.random.uniform", lambda a, b: 1.0)
+    requester = ReplicaRequester(["http://a"], retry_count=3, backoff_base=0.05, backoff_max=0.08)
+    loop = asyncio.get_running_loop()
+    times = []
+
+    async def send(base_url: str, timeout: float):
+        times.append(loop.time())
+        raise aiohttp.ClientConnectionError()
+
+    with pytest.raises(aiohttp.ClientConnectionError):
+        await requester.arequest(send, 5.0)
+
+    # Backoff doubles up to backoff_max: 0.05, 0.08 (capped), 0.08
+    gaps = [t2 - t1 for t1, t2 in zip(times, times[1:])]
+    assert len(gaps) == 3
+    assert 0.05 <= gaps[0] < 0.08
+    assert gaps[1] >= 0.08 and gaps[2] >= 0.08
+    assert max(gaps) < 0.5
+
+
+@pytest.mark.asyncio
+async def test_deadline():
+    requester = ReplicaRequester(["http://a"], retry_count=5, backoff_base=0.01)
+    loop = asyncio.get_running_loop()
+    calls = []
+
+    async def slow(base_url: str, timeout: float):
+        calls.append(timeout)
+        await asyncio.sleep(1.0)
+
+    # All attempts share the deadline of the call
+    start = loop.time()
+    with pytest.raises(asyncio.TimeoutError):
+        await requester.arequest(slow, 0.1)
+    assert loop.time() - start < 0.5
+    assert all(t <= 0.1 for t in calls)
+
+    # No backoff beyond the deadline
+    requester = ReplicaRequester(["http://a"], retry_count=5, backoff_base=1.0)
+    calls.clear()
+    async def fail(base_url: str, timeout: float):
+        calls.append(timeout)
+        raise aiohttp.ClientConnectionError()
+
+    start = loop.time()
+    with pytest.raises(aiohttp.ClientConnectionError):
+        await requester.arequest(fail, 0.2)
+    assert loop.time() - start < 0.2
+    assert len(calls) == 1
+
+    # No deadline if timeout is None
+    requester = ReplicaRequester(["http://a"], retry_count=1, backoff_base=0.01)
+    calls.clear()
+    async def flaky(base_url: str, timeout: float):
+        calls.append(timeout)
+        if len(calls) < 2:
+            raise aiohttp.ClientConnectionError()
+        return "ok"
+
+    assert await requester.arequest(flaky, None) == "ok"
+    assert calls == [None, None]
+
+
+@pytest.mark.asyncio
+async def test_hedging():
+    requester = ReplicaRequester(["http://slow", "http://fast"], retry_count=0, hedge=True, hedge_min_samples=3)
+    calls = []
+
+    async def send(base_url: str, timeout: float):
+        calls.append(base_url)
+        if base_url == "http://slow":
+            await asyncio.sleep(1.0)
+        return base_url
+
+    # Not hedged until enough latencies are sampled
+    assert requester.get_hedge_delay() is None
+    requester.latencies.extend([0.01, 0.01, 0.02])
+    assert requester.get_hedge_delay() == 0.02
+
+    # Slow primary is hedged to the other replica
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    assert await requester.arequest(send, 5.0) == "http://fast"
+    assert loop.time() - start < 0.5
+    assert calls == ["http://slow", "http://fast"]
+
+    # Fast primary is not hedged
+    calls.clear()
+    requester.url_cycle = iter(["http://fast", "http://slow"])
+    assert await requester.arequest(send, None) == "http://fast"
+    assert calls == ["http://fast"]
+
+    # Not hedged when the delay exceeds the timeout
+    calls.clear()
+    requester.url_cycle = iter(["http://slow", "http://fast"])
+    requester.latencies.clear()
+    requester.latencies.extend([0.5, 0.5, 0.5])
+    with pytest.raises(asyncio.TimeoutError):
+        await requester.arequest(send, 0.1)
+    assert calls == ["http://slow"]
+
+    # Error of the primary waits for the hedged request
+    calls.clear()
+    requester.latencies.clear()
+    requester.latencies.extend([0.01, 0.01, 0.01])
+    requester.url_cycle = iter(["http://a", "http://b"])
+    async def primary_fails(base_url: str, timeout: float):
+        calls.append(base_url)
+        await asyncio.sleep(0.05)
+        if base_url == "http://a":
+            raise aiohttp.ClientConnectionError()
+        await asyncio.sleep(0.05)
+        return base_url
+
+    assert await requester.arequest(primary_fails, 5.0) == "http://b"
@@ -1,6 +1,11 @@
+import asyncio
 import os
 import pytest
-from vsslite import VSSLite
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from vsslite import VSSLite, HashingEmbeddingProvider
+from vsslite.loop import get_loop_runner
 
 API_KEY = os.environ.get("OPENAI_APIKEY")
 
@@ -231,3 +236,470 @@ def test_bulk_csv():
     assert s5[0]["body"] == "up:Red pandas are smaller than pandas, but when it comes to cuteness, there is no \"lesser\" about them."
     s6 = vss.search("food")
     assert s6[0]["body"] == "up:There is no difference between \"Ohagi\" and \"Botamochi\" themselves; they are used interchangeably depending on the season."
+
+
+def test_connection_pool():
+    vss = VSSLite(API_KEY, "tests/data/vsstest_pool.db", pool_size=2, pragmas={"journal_mode": "WAL", "cache_size": -2000})
+
+    conn1 = vss.get_connection()
+    conn2 = vss.get_connection()
+    assert conn1 is not conn2
+    assert vss.pool.created_count == 2
+    assert conn1.execute("pragma journal_mode").fetchone()[0] == "wal"
+    assert conn1.execute("pragma cache_size").fetchone()[0] == -2000
+    assert conn1.execute("select vss_version()").fetchone()[0]
+
+    # Released connections are reused instead of reconnecting
+    vss.release_connection(conn2)
+    assert vss.get_connection() is conn2
+    vss.release_connection(conn1)
+    vss.release_connection(conn2)
+    assert vss.pool.created_count == 2
+
+    vss.close()
+
+
+@pytest.mark.asyncio
+async def test_executor_stats():
+    vss = VSSLite(API_KEY, "tests/data/vsstest_executor.db", reader_count=2)
+    await vss.adelete_all()
+
+    # Reads run concurrently on reader threads
+    results = await asyncio.gather(*[vss.aget(i) for i in range(10)])
+    assert results == [None] * 10
+
+    stats = vss.get_stats()
+    assert stats["reader"]["workers"] == 2
+    assert stats["reader"]["pending"] == 0
+    assert stats["reader"]["completed"] == 10
+    assert stats["writer"]["workers"] == 1
+    assert stats["writer"]["completed"] == 1
+
+    vss.close()
+
+
+@pytest.mark.asyncio
+async def test_aadd_many():
+    vss = VSSLite(API_KEY, "tests/data/vsstest_add_many.db", embedding_batch_size=2)
+    await vss.adelete_all()
+
+    ids = await vss.aadd_many([
+        "The difference between eel and conger eel is that eel is more expensive.",
+        "Red pandas are smaller than pandas, but when it comes to cuteness, there is no \"lesser\" about them.",
+        "There is no difference between \"Ohagi\" and \"Botamochi\" themselves; they are used interchangeably depending on the season."
+    ], [{"url": "eel"}, {"url": "panda"}, {"url": "ohagi"}])
+    assert ids == [1, 2, 3]
+
+    r3 = await vss.aget(3)
+    assert r3["body"] == "There is no difference between \"Ohagi\" and \"Botamochi\" themselves; they are used interchangeably depending on the season."
+    assert r3["data"] == {"url": "ohagi"}
+
+    s1 = await vss.asearch("fish")
+    assert s1[0]["id"] == 1
+
+
+def test_make_batches():
+    vss = VSSLite(API_KEY, "tests/data/vsstest_add_many.db", embedding_batch_size=3, embedding_batch_tokens=10)
+    assert vss.make_batches(["a", "b", "c", "d", "e"]) == [[0, 1, 2], [3, 4]]
+    assert vss.make_batches(["one two three four five six seven eight", "nine ten eleven", "twelve"]) == [[0], [1, 2]]
+
+
+@pytest.mark.asyncio
+async def test_hashing_embedding_provider():
+    vss = VSSLite(None, "tests/data/vsstest_hashing.db", embedding_provider=HashingEmbeddingProvider(dimension=64))
+    await vss.adelete_all()
+    assert vss.dimension == 64
+
+    id1 = await vss.aadd("The difference between eel and conger eel is that eel is more expensive.")
+    id2 = await vss.aadd("Red pandas are smaller than pandas, but when it comes to cuteness, there is no \"lesser\" about them.")
+
+    r1 = await vss.aget(id1)
+    assert len(r1["body_embedding"]) == 64
+
+    # Same text always gets the same embedding
+    assert r1["body_embedding"] == (await vss.aget(await vss.aadd(r1["body"])))["body_embedding"]
+
+    s1 = await vss.asearch("red pandas", count=1)
+    assert s1[0]["id"] == id2
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache():
+    vss = VSSLite(None, "tests/data/vsstest_cache.db", embedding_provider=HashingEmbeddingProvider(dimension=64), persistent_embedding_cache_size=3)
+    await vss.adelete_all()
+    conn = vss.get_connection()
+    conn.execute("delete from embedding_cache")
+    vss.release_connection(conn)
+    vss.persistent_embedding_cache_count = 0
+
+    id1 = await vss.aadd("The difference between eel and conger eel is that eel is more expensive.")
+    assert vss.get_stats()["embedding_cache"]["misses"] == 1
+
+    # Unchanged body and identical (normalized) queries hit the in-memory tier
+    await vss.aupdate(id1, "The difference between eel and conger eel is that eel is more expensive.")
+    await vss.asearch(" The difference between eel and  conger eel is that eel is more expensive.")
+    stats = vss.get_stats()["embedding_cache"]
+    assert stats["misses"] == 1
+    assert stats["memory_hits"] == 2
+
+    # Another engine on the same database hits the persistent tier
+    vss2 = VSSLite(None, "tests/data/vsstest_cache.db", embedding_provider=HashingEmbeddingProvider(dimension=64))
+    await vss2.asearch("The difference between eel and conger eel is that eel is more expensive.")
+    stats2 = vss2.get_stats()["embedding_cache"]
+    assert stats2["misses"] == 0
+    assert stats2["persistent_hits"] == 1
+
+    # Queries are persisted only when enabled
+    def count_persisted():
+        conn = vss.get_connection()
+        try:
+            return conn.execute("select count(*) from embedding_cache").fetchone()[0]
+        finally:
+            vss.release_connection(conn)
+
+    await vss.asearch("Conger eel is cheaper")
+    await vss.executor.awrite(lambda: None)
+    assert count_persisted() == 1
+    vss.persist_query_embeddings = True
+    await vss.asearch("Eel is more expensive")
+    await vss.executor.awrite(lambda: None)
+    assert count_persisted() == 2
+
+    # Embeddings are kept as float32 arrays in memory
+    assert all(v.dtype == np.float32 for v in vss.embedding_cache.items.values())
+
+    # The oldest embeddings are evicted from the persistent tier
+    await vss.aadd_many([f"Conger eel note {i}" for i in range(4)])
+    conn = vss.get_connection()
+    assert conn.execute("select count(*) from embedding_cache").fetchone()[0] == 3
+    vss.release_connection(conn)
+
+
+@pytest.mark.asyncio
+async def test_search_namespace():
+    # Search with the sqlite-vss index, not the exact search
+    vss = VSSLite(None, "tests/data/vsstest_namespace.db", embedding_provider=HashingEmbeddingProvider(dimension=64), exact_search_threshold=0)
+    await vss.adelete_all()
+
+    await vss.aadd_many([f"Eel recipe number {i}" for i in range(50)], namespace="large")
+    small_ids = await vss.aadd_many([f"Conger eel note {i}" for i in range(15)], namespace="small")
+
+    # count over 10 is honored and records in other namespaces don't push out the target namespace
+    s1 = await vss.asearch("Eel recipe number 1", count=12, namespace="small")
+    assert len(s1) == 12
+    assert all(r["namespace"] == "small" and r["id"] in small_ids for r in s1)
+    assert [r["distance"] for r in s1] == sorted(r["distance"] for r in s1)
+
+    s2 = await vss.asearch("Eel recipe", count=100, namespace="small")
+    assert len(s2) == 15
+
+    assert await vss.asearch("Eel recipe", count=3, namespace="empty") == []
+
+    # Counts are stored and updated on write
+    def select_counts(namespace):
+        conn = vss.get_connection()
+        try:
+            return vss.select_counts(conn, namespace)
+        finally:
+            vss.release_connection(conn)
+
+    assert select_counts("small") == (15, 65)
+    id = await vss.aadd("Conger eel recipe", namespace="small")
+    id = await vss.aupdate(id, "Conger eel recipe 2")
+    await vss.adelete(small_ids[0])
+    assert select_counts("small") == (15, 65)
+    assert select_counts("empty") == (0, 65)
+
+    # Existing records are counted when the table is created
+    conn = vss.get_connection()
+    conn.execute("drop table record_counts")
+    vss.release_connection(conn)
+    VSSLite(None, "tests/data/vsstest_namespace.db", embedding_provider=HashingEmbeddingProvider(dimension=64))
+    assert select_counts("large") == (50, 65)
+
+    await vss.adelete_all()
+    assert select_counts("small") == (0, 0)
+
+
+@pytest.mark.asyncio
+async def test_exact_search():
+    vss = VSSLite(None, "tests/data/vsstest_exact.db", embedding_provider=HashingEmbeddingProvider(dimension=64))
+    vss_index = VSSLite(None, "tests/data/vsstest_exact.db", embedding_provider=HashingEmbeddingProvider(dimension=64), exact_search_threshold=0)
+    await vss.adelete_all()
+
+    ids = await vss.aadd_many([f"Eel recipe number {i}" for i in range(30)], namespace="fish")
+    await vss.aadd_many([f"Red panda photo {i}" for i in range(30)], namespace="animal")
+
+    # Same results as vss0. Records at the same distance may be in another order so compare top 4 of distinct distances
+    s1 = await vss.asearch("Eel recipe number 3", count=4, namespace="fish")
+    s2 = await vss_index.asearch("Eel recipe number 3", count=4, namespace="fish")
+    assert [r["id"] for r in s1] == [r["id"] for r in s2]
+    assert [r["distance"] for r in s1] == pytest.approx([r["distance"] for r in s2], abs=1e-4)
+    assert "fish" in vss.matrices
+
+    # Matrix is kept in sync with add, update and delete
+    new_id = await vss.aupdate(ids[3], "Conger eel recipe")
+    s3 = await vss.asearch("Eel recipe number 3", count=30, namespace="fish")
+    assert ids[3] not in [r["id"] for r in s3]
+    s4 = await vss.asearch("Conger eel recipe", count=1, namespace="fish")
+    assert s4[0]["id"] == new_id
+    await vss.adelete(new_id)
+    s5 = await vss.asearch("Conger eel recipe", count=30, namespace="fish")
+    assert new_id not in [r["id"] for r in s5]
+    assert len(s5) == 29
+
+    # Matrix is allocated in the exact size and least recently used ones are released over max_matrix_bytes
+    vss2 = VSSLite(None, "tests/data/vsstest_exact.db", embedding_provider=HashingEmbeddingProvider(dimension=64))
+    await vss2.asearch("Eel recipe", namespace="fish")
+    assert len(vss2.matrices["fish"].ids) == 29
+    vss2.max_matrix_bytes = vss2.matrices["fish"].nbytes
+    await vss2.asearch("Red panda", namespace="animal")
+    assert list(vss2.matrices) == ["animal"]
+    assert vss2.get_stats()["matrices"]["count"] == 1
+    s6 = await vss2.asearch("Eel recipe number 5", count=1, namespace="fish")
+    assert s6[0]["id"] == ids[5]
+    assert list(vss2.matrices) == ["fish"]
+
+
+@pytest.mark.asyncio
+async def test_matrix_loading(monkeypatch):
+    vss = VSSLite(None, "tests/data/vsstest_exact.db", embedding_provider=HashingEmbeddingProvider(dimension=64))
+    await vss.adelete_all()
+    await vss.aadd_many([f"Eel recipe number {i}" for i in range(10)], namespace="a")
+    b_ids = await vss.aadd_many([f"Conger eel note {i}" for i in range(10)], namespace="b")
+    assert (await vss.asearch("Conger eel note 1", namespace="b"))[0]["id"] == b_ids[1]
+
+    # Hold the matrix of namespace a after it is read from the database
+    loaded, release = threading.Event(), threading.Event()
+    load_matrix = vss.load_matrix
+    def slow_load_matrix(conn, namespace):
+        matrix = load_matrix(conn, namespace)
+        loaded.set()
+        release.wait(5)
+        return matrix
+    monkeypatch.setattr(vss, "load_matrix", slow_load_matrix)
+
+    loop = asyncio.get_running_loop()
+    search_a = asyncio.gather(*[vss.asearch("Red pandas", count=1, namespace="a") for _ in range(2)])
+    assert await loop.run_in_executor(None, loaded.wait, 5)
+
+    # Searches of other namespaces and writes are not blocked while loading
+    assert (await vss.asearch("Conger eel note 2", namespace="b"))[0]["id"] == b_ids[2]
+    id1 = await vss.aadd("Red pandas are smaller than pandas.", namespace="a")
+    assert not release.is_set()
+
+    # Writes committed while loading are applied to the loaded matrix
+    release.set()
+    await search_a
+    assert vss.loading_matrices == {}
+    assert id1 in vss.matrices["a"].rows
+    assert (await vss.asearch("Red pandas", count=1, namespace="a"))[0]["id"] == id1
+    assert vss.get_stats()["matrices"]["count"] == 2
+
+
+@pytest.mark.asyncio
+async def test_asearch_many():
+    vss = VSSLite(None, "tests/data/vsstest_search_many.db", embedding_provider=HashingEmbeddingProvider(dimension=64))
+    await vss.adelete_all()
+
+    await vss.aadd_many([f"Eel recipe number {i}" for i in range(10)] + [f"Red panda photo {i}" for i in range(10)])
+
+    queries = ["Eel recipe number 3", "Red panda photo 7", "Eel recipe number 3"]
+    results = await vss.asearch_many(queries, count=3)
+    assert len(results) == 3
+    for q, r in zip(queries, results):
+        s = await vss.asearch(q, count=3)
+        assert [x["id"] for x in r] == [x["id"] for x in s]
+        assert [x["distance"] for x in r] == pytest.approx([x["distance"] for x in s], abs=1e-4)
+    assert results[0][0]["body"] == "Eel recipe number 3"
+    assert results[1][0]["body"] == "Red panda photo 7"
+
+    assert await vss.asearch_many([]) == []
+
+
+@pytest.mark.asyncio
+async def test_quantization(monkeypatch):
+    vss = VSSLite(None, "tests/data/vsstest_quantization.db", embedding_provider=HashingEmbeddingProvider(dimension=64))
+    await vss.adelete_all()
+    await vss.aadd_many([f"Eel recipe number {i}" for i in range(30)])
+    await vss.aadd_many([f"Red panda photo {i}" for i in range(10)], namespace="other")
+    expected = await vss.asearch("Eel recipe number 3", count=5)
+
+    # Quantize in pages
+    monkeypatch.setattr(VSSLite, "vector_page_size", 7)
+
+    for quantization in ["float16", "int8"]:
+        # Codes are made in memory from float32 vectors, not stored
+        vss_q = VSSLite(None, "tests/data/vsstest_quantization.db", embedding_provider=HashingEmbeddingProvider(dimension=64), quantization=quantization)
+        assert vss_q.matrices == {}
+        conn = vss_q.get_connection()
+        assert conn.execute("select name from sqlite_master where name = 'embedding_codes'").fetchone() is None
+        vss_q.release_connection(conn)
+        s1 = await vss_q.asearch("Eel recipe number 3", count=5)
+        assert vss_q.matrices["default"].vectors.dtype.name == quantization
+        assert len(vss_q.matrices["default"].rows) == 30
+
+        # Reranked with float32 vectors
+        assert s1[0]["id"] == expected[0]["id"]
+        assert [r["distance"] for r in s1] == pytest.approx([r["distance"] for r in expected], abs=1e-4)
+
+        id = await vss_q.aadd("Conger eel recipe")
+        s2 = await vss_q.asearch("Conger eel recipe", count=1)
+        assert s2[0]["id"] == id
+        await vss_q.adelete(id)
+
+
+@pytest.mark.asyncio
+async def test_rebuild_index(monkeypatch):
+    # Copy and index vectors across pages
+    monkeypatch.setattr(VSSLite, "vector_page_size", 7)
+    vss = VSSLite(None, "tests/data/vsstest_index.db", embedding_provider=HashingEmbeddingProvider(dimension=64), exact_search_threshold=0)
+    await vss.adelete_all()
+    ids = await vss.aadd_many([f"Eel recipe number {i}" for i in range(100)])
+
+    ret = await vss.arebuild_index("IVF4,Flat", sample_size=50)
+    assert ret == {"index_factory": "IVF4,Flat", "trained_count": 50, "indexed_count": 100}
+    assert vss.vector_table == "embedding_vectors"
+
+    # Vectors are read from the regular table
+    record = await vss.aget(ids[3])
+    assert len(record["body_embedding"]) == 64
+
+    s = await vss.asearch("Eel recipe number 3", count=1)
+    assert s[0]["id"] == ids[3]
+
+    await vss.adelete(ids[3])
+    s = await vss.asearch("Eel recipe number 3", count=1)
+    assert s[0]["id"] != ids[3]
+
+    # Factory is kept when re-training
+    ret = await vss.atrain_index()
+    assert ret["index_factory"] == "IVF4,Flat"
+    assert ret["indexed_count"] == 99
+
+    vss2 = VSSLite(None, "tests/data/vsstest_index.db", embedding_provider=HashingEmbeddingProvider(dimension=64))
+    assert vss2.vector_table == "embedding_vectors"
+    s = await vss2.asearch("Eel recipe number 4", count=1)
+    assert s[0]["id"] == ids[4]
+
+    # Back to the default index
+    ret = await vss.arebuild_index("Flat")
+    assert ret == {"index_factory": "Flat", "trained_count": 99, "indexed_count": 99}
+    for i in [0, 50, 99]:
+        assert (await vss.asearch(f"Eel recipe number {i}", count=1))[0]["id"] == ids[i]
+
+    await vss.adelete_all()
+
+
+@pytest.mark.asyncio
+async def test_rebuild_index_transform():
+    vss = VSSLite(None, "tests/data/vsstest_index.db", embedding_provider=HashingEmbeddingProvider(dimension=64), exact_search_threshold=0)
+    await vss.adelete_all()
+    ids = await vss.aadd_many([f"Eel recipe number {i}" for i in range(200)])
+
+    # IVF behind a transform stores ids by itself without IDMap2
+    assert VSSLite.make_index_factory("PCA16,IVF4,Flat") == "PCA16,IVF4,Flat"
+    assert VSSLite.make_index_factory("OPQ16_64,IVF4096,PQ16") == "OPQ16_64,IVF4096,PQ16"
+    assert VSSLite.make_index_factory("PCA16,Flat") == "PCA16,Flat,IDMap2"
+    ret = await vss.arebuild_index("PCA16,IVF4,Flat")
+    assert ret["indexed_count"] == 200
+
+    # Records can be deleted and updated
+    await vss.adelete(ids[3])
+    assert await vss.aget(ids[3]) is None
+    id1 = await vss.aupdate(ids[4], "Red pandas are smaller than pandas.")
+    assert (await vss.aget(id1))["body"] == "Red pandas are smaller than pandas."
+    assert all(r["id"] not in (ids[3], ids[4]) for r in await vss.asearch("Eel recipe number 3", count=10))
+
+    await vss.adelete_all()
+
+
+@pytest.mark.asyncio
+async def test_index_factory_existing_index():
+    vss = VSSLite(None, "tests/data/vsstest_factory.db", embedding_provider=HashingEmbeddingProvider(dimension=64), exact_search_threshold=0)
+    await vss.adelete_all()
+    id1 = await vss.aadd("The difference between eel and conger eel is that eel is more expensive.")
+
+    # Factory is ignored for the existing index and vectors are still read from it
+    vss2 = VSSLite(None, "tests/data/vsstest_factory.db", embedding_provider=HashingEmbeddingProvider(dimension=64), exact_search_threshold=0, index_factory="IVF4,Flat")
+    assert vss2.index_factory is None
+    assert vss2.vector_table == "embeddings"
+    assert len((await vss2.aget(id1))["body_embedding"]) == 64
+    assert (await vss2.asearch("eel", count=1))[0]["id"] == id1
+
+    await vss.adelete_all()
+
+
+@pytest.mark.asyncio
+async def test_index_factory_untrained():
+    vss = VSSLite(None, "tests/data/vsstest_untrained.db", embedding_provider=HashingEmbeddingProvider(dimension=64), exact_search_threshold=0, index_factory="IVF4,Flat")
+    await vss.adelete_all()
+    await vss.arebuild_index("IVF4,Flat")
+    assert vss.index_trained is False
+
+    # Records can be added, updated and deleted before training and are searched exactly
+    ids = await vss.aadd_many([f"Eel recipe number {i}" for i in range(100)])
+    id1 = await vss.aadd("Red pandas are smaller than pandas.")
+    assert len((await vss.aget(ids[3]))["body_embedding"]) == 64
+    assert (await vss.asearch("Eel recipe number 3", count=1))[0]["id"] == ids[3]
+    id1 = await vss.aupdate(id1, "Red pandas are cuter than pandas.")
+    await vss.adelete(ids[4])
+
+    ret = await vss.atrain_index(sample_size=50)
+    assert ret["indexed_count"] == 100
+    assert vss.index_trained is True
+    # IVF probes only the nearest list, so search with the stored text itself
+    assert (await vss.asearch("Red pandas are cuter than pandas.", count=1))[0]["id"] == id1
+    assert (await vss.asearch("Eel recipe number 4", count=1))[0]["id"] != ids[4]
+
+    vss2 = VSSLite(None, "tests/data/vsstest_untrained.db", embedding_provider=HashingEmbeddingProvider(dimension=64), exact_search_threshold=0)
+    assert vss2.index_trained is True
+    assert (await vss2.asearch("Eel recipe number 3", count=1))[0]["id"] == ids[3]
+
+    await vss.adelete_all()
+
+
+def test_index_factory_unsupported():
+    # HNSW can't remove vectors on delete and update
+    with pytest.raises(ValueError):
+        VSSLite(None, "tests/data/vsstest_hnsw.db", embedding_provider=HashingEmbeddingProvider(dimension=64), index_factory="HNSW32")
+
+    vss = VSSLite(None, "tests/data/vsstest_hnsw.db", embedding_provider=HashingEmbeddingProvider(dimension=64))
+    with pytest.raises(ValueError):
+        vss.rebuild_index("HNSW32,Flat")
+    assert vss.index_factory is None
+
+
+def test_sync_threads():
+    vss = VSSLite(None, "tests/data/vsstest_threads.db", embedding_provider=HashingEmbeddingProvider(dimension=64))
+    vss.delete_all()
+
+    # Sync APIs can be called from many threads at once
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        ids = list(executor.map(lambda i: vss.add(f"Eel recipe number {i}"), range(32)))
+        results = list(executor.map(lambda i: vss.search(f"Eel recipe number {i}", count=1), range(32)))
+
+    assert len(set(ids)) == 32
+    assert [r[0]["id"] for r in results] == ids
+    assert vss.get_stats()["writer"]["pending"] == 0
+
+
+@pytest.mark.asyncio
+async def test_sync_in_running_loop():
+    vss = VSSLite(None, "tests/data/vsstest_threads.db", embedding_provider=HashingEmbeddingProvider(dimension=64))
+    vss.delete_all()
+
+    # Sync APIs work inside a running loop
+    id1 = vss.add("The difference between eel and conger eel is that eel is more expensive.")
+    assert vss.get(id1)["body"] == "The difference between eel and conger eel is that eel is more expensive."
+    assert vss.search("eel", count=1)[0]["id"] == id1
+
+    # but not on the event loop of VSSLite itself
+    async def search_on_vsslite_loop():
+        return vss.search("eel", count=1)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run_coroutine_threadsafe(search_on_vsslite_loop(), get_loop_runner().loop).result(5)
+
+    # The loop keeps working after that
+    assert vss.search("eel", count=1)[0]["id"] == id1
@@ -1,4 +1,5 @@
 try:
+    from .embeddings import EmbeddingProvider, OpenAIEmbeddingProvider, HashingEmbeddingProvider, ONNXEmbeddingProvider
     from .vsslite import VSSLite
     from .server import VSSLiteServer
 except:
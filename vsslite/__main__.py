@@ -28,14 +28,31 @@ parser.add_argument("--dir", type=str, default="./vectorstore", required=False,
 parser.add_argument("--chunksize", type=int, default=500, required=False, help="Chunk size")
 parser.add_argument("--chunkoverlap", type=int, default=0, required=False, help="Chunk overlap")
 parser.add_argument("--vectorstore", type=str, default="chromadb", required=False, help="Chunk overlap")
+parser.add_argument("--embedding", type=str, default="openai", required=False, help="Embedding provider for sqlite: openai, hashing or onnx")
+parser.add_argument("--dimension", type=int, default=None, required=False, help="Dimension of embeddings for sqlite")
+parser.add_argument("--onnxmodel", type=str, default=None, required=False, help="Path to ONNX model for onnx embedding provider")
+parser.add_argument("--onnxtokenizer", type=str, default=None, required=False, help="Path to tokenizer.json for onnx embedding provider")
+parser.add_argument("--indexfactory", type=str, default=None, required=False, help="Faiss index factory for sqlite (e.g. PQ32). IVF indexes probe only one list")
 args = parser.parse_args()
 
 
 if args.vectorstore == "sqlite":
     from vsslite import VSSLiteServer
+    if args.embedding == "hashing":
+        from vsslite import HashingEmbeddingProvider
+        embedding_provider = HashingEmbeddingProvider(dimension=args.dimension or 256)
+    elif args.embedding == "onnx":
+        from vsslite import ONNXEmbeddingProvider
+        embedding_provider = ONNXEmbeddingProvider(args.onnxmodel, args.onnxtokenizer, dimension=args.dimension)
+    else:
+        from vsslite import OpenAIEmbeddingProvider
+        embedding_provider = OpenAIEmbeddingProvider(args.apikey, dimension=args.dimension or 1536)
+
     vss = VSSLiteServer(
         openai_apikey=args.apikey,
-        connection_str=args.dir
+        connection_str=args.dir,
+        embedding_provider=embedding_provider,
+        index_factory=args.indexfactory
     )
 
 else:
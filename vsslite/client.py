@@ -1,34 +1,90 @@
-import aiofiles
 import aiohttp
 from aiohttp.client_exceptions import ClientResponseError
 import asyncio
-import csv
-import json
 from logging import getLogger, NullHandler
+import threading
 import traceback
-from typing import List
+from typing import Callable, List
+import weakref
+from .loop import run_sync
+from .records import aiter_records
+from .requester import ReplicaRequester
 
 logger = getLogger(__name__)
 logger.addHandler(NullHandler())
 
 
 class VSSLiteClient:
-    def __init__(self, base_url: str="http://127.0.0.1:8000", timeout=10):
-        self.base_url = base_url
+    def __init__(self, base_url: str="http://127.0.0.1:8000", timeout=10, connection_limit: int=100, keepalive_timeout: float=30, dns_ttl: int=300, base_urls: List[str]=None, retry_count: int=2, backoff_base: float=0.1, backoff_max: float=2.0, hedge: bool=False):
+        # Idempotent calls (get and search) are retried and optionally hedged across base_urls
+        self.base_url = base_urls[0] if base_urls else base_url
         self.timeout = timeout
+        self.requester = ReplicaRequester(base_urls or [base_url], retry_count, backoff_base, backoff_max, hedge)
+        self.connection_limit = connection_limit
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_ttl = dns_ttl
+        # Sessions are bound to the event loop that made them so keep one per loop
+        self.sessions = weakref.WeakKeyDictionary()
+        self.sessions_lock = threading.Lock()
     
     def sync(self, future):
-        return asyncio.get_event_loop().run_until_complete(future)
+        # Run on the shared background loop so that this works from any thread or inside running loops
+        return run_sync(future)
+
+    def get_session(self) -> aiohttp.ClientSession:
+        # Reuse a long-lived session per event loop to keep connections alive
+        loop = asyncio.get_running_loop()
+        with self.sessions_lock:
+            session = self.sessions.get(loop)
+            if session is None or session.closed:
+                # Sessions refer to their loop so entries of closed loops don't vanish by themselves
+                for closed_loop in [l for l in self.sessions if l.is_closed()]:
+                    del self.sessions[closed_loop]
+                session = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(
+                        limit=self.connection_limit,
+                        keepalive_timeout=self.keepalive_timeout,
+                        ttl_dns_cache=self.dns_ttl
+                    ),
+                    raise_for_status=True
+                )
+                self.sessions[loop] = session
+            return session
+
+    async def aclose(self):
+        current_loop = asyncio.get_running_loop()
+        with self.sessions_lock:
+            sessions = list(self.sessions.items())
+            self.sessions.clear()
+
+        for loop, session in sessions:
+            if session.closed or loop.is_closed():
+                continue
+            if loop is current_loop:
+                await session.close()
+            elif loop.is_running():
+                # Close on the loop that owns the session without waiting for it.
+                # That loop may be blocked by sync close() and runs this when it resumes
+                asyncio.run_coroutine_threadsafe(session.close(), loop)
+
+    def close(self):
+        self.sync(self.aclose())
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        await self.aclose()
     
     async def aadd(self, body: str, data: dict=None, namespace: str="default") -> int:
         try:
-            async with aiohttp.ClientSession(raise_for_status=True) as client_session:
-                async with client_session.post(
-                    self.base_url + f"/knowledge/{namespace}",
-                    json={"body": body, "data": data},
-                    timeout=self.timeout
-                ) as resp:
-                    return (await resp.json())["id"]
+            client_session = self.get_session()
+            async with client_session.post(
+                self.base_url + f"/knowledge/{namespace}",
+                json={"body": body, "data": data},
+                timeout=self.timeout
+            ) as resp:
+                return (await resp.json())["id"]
 
         except Exception as ex:
             logger.error(f"Error at VSSEngine.add: {str(ex)}\n{traceback.format_exc()}")
@@ -37,15 +93,33 @@ class VSSLiteClient:
     def add(self, body: str, data: dict=None, namespace: str="default") -> int:
         return self.sync(self.aadd(body, data, namespace))
     
+    async def aadd_many(self, bodies: List[str], data_list: List[dict]=None, namespace: str="default") -> List[int]:
+        try:
+            data_list = data_list or [None] * len(bodies)
+            client_session = self.get_session()
+            async with client_session.post(
+                self.base_url + f"/knowledge/{namespace}/batch",
+                json={"records": [{"body": b, "data": d} for b, d in zip(bodies, data_list)]},
+                timeout=self.timeout
+            ) as resp:
+                return (await resp.json())["ids"]
+
+        except Exception as ex:
+            logger.error(f"Error at VSSEngine.add_many: {str(ex)}\n{traceback.format_exc()}")
+            raise ex
+
+    def add_many(self, bodies: List[str], data_list: List[dict]=None, namespace: str="default") -> List[int]:
+        return self.sync(self.aadd_many(bodies, data_list, namespace))
+
     async def aupdate(self, id: int, body: str, data: dict=None) -> int:
         try:
-            async with aiohttp.ClientSession(raise_for_status=True) as client_session:
-                async with client_session.patch(
-                    self.base_url + f"/knowledge/{id}",
-                    json={"body": body, "data": data},
-                    timeout=self.timeout
-                ) as resp:
-                    return (await resp.json())["id"]
+            client_session = self.get_session()
+            async with client_session.patch(
+                self.base_url + f"/knowledge/{id}",
+                json={"body": body, "data": data},
+                timeout=self.timeout
+            ) as resp:
+                return (await resp.json())["id"]
         
         except Exception as ex:
             logger.error(f"Error at VSSEngine.update: {str(ex)}\n{traceback.format_exc()}")
@@ -56,12 +130,12 @@ class VSSLiteClient:
 
     async def adelete(self, id: int):
         try:
-            async with aiohttp.ClientSession(raise_for_status=True) as client_session:
-                async with client_session.delete(
-                    self.base_url + f"/knowledge/{id}",
-                    timeout=self.timeout
-                ):
-                    pass
+            client_session = self.get_session()
+            async with client_session.delete(
+                self.base_url + f"/knowledge/{id}",
+                timeout=self.timeout
+            ):
+                pass
 
         except Exception as ex:
             logger.error(f"Error at VSSEngine.delete: {str(ex)}\n{traceback.format_exc()}")
@@ -72,12 +146,12 @@ class VSSLiteClient:
 
     async def adelete_all(self):
         try:
-            async with aiohttp.ClientSession(raise_for_status=True) as client_session:
-                async with client_session.delete(
-                    self.base_url + f"/knowledge/all",
-                    timeout=self.timeout
-                ):
-                    pass
+            client_session = self.get_session()
+            async with client_session.delete(
+                self.base_url + f"/knowledge/all",
+                timeout=self.timeout
+            ):
+                pass
 
         except Exception as ex:
             logger.error(f"Error at VSSEngine.delete_all: {str(ex)}\n{traceback.format_exc()}")
@@ -86,15 +160,17 @@ class VSSLiteClient:
     def delete_all(self):
         self.sync(self.adelete_all())
 
-    async def aget(self, id: int) -> dict:
+    async def aget(self, id: int, timeout: float=None) -> dict:
         try:
-            async with aiohttp.ClientSession(raise_for_status=True) as client_session:
-                async with client_session.get(
-                    self.base_url + f"/knowledge/{id}",
-                    timeout=self.timeout
+            async def send(base_url: str, timeout: float):
+                async with self.get_session().get(
+                    base_url + f"/knowledge/{id}",
+                    timeout=timeout
                 ) as resp:
                     return await resp.json()
 
+            return await self.requester.arequest(send, timeout or self.timeout)
+
         except ClientResponseError as crerr:
             if crerr.status == 404:
                 return None
@@ -104,50 +180,154 @@ class VSSLiteClient:
             logger.error(f"Error at VSSEngine.get: {str(ex)}\n{traceback.format_exc()}")
             raise ex
 
-    def get(self, id: int) -> dict:
-        return self.sync(self.aget(id))
+    def get(self, id: int, timeout: float=None) -> dict:
+        return self.sync(self.aget(id, timeout))
 
-    async def asearch(self, query: str, count: int=1, namespace: str="default") -> List[dict]:
+    async def asearch(self, query: str, count: int=1, namespace: str="default", timeout: float=None) -> List[dict]:
         try:
-            async with aiohttp.ClientSession(raise_for_status=True) as client_session:
-                async with client_session.get(
-                    self.base_url + f"/knowledge/{namespace}/search",
+            async def send(base_url: str, timeout: float):
+                async with self.get_session().get(
+                    base_url + f"/knowledge/{namespace}/search",
                     params={"q": query, "count": count},
-                    timeout=self.timeout
+                    timeout=timeout
                 ) as resp:
                     return (await resp.json())["results"]
 
+            return await self.requester.arequest(send, timeout or self.timeout)
+
         except Exception as ex:
             logger.error(f"Error at VSSEngine.search: {str(ex)}\n{traceback.format_exc()}")
             raise ex
     
-    def search(self, query: str, count: int=1, namespace: str="default") -> List[dict]:
-        return self.sync(self.asearch(query, count, namespace))
+    def search(self, query: str, count: int=1, namespace: str="default", timeout: float=None) -> List[dict]:
+        return self.sync(self.asearch(query, count, namespace, timeout))
+
+    async def asearch_many(self, queries: List[str], count: int=1, namespace: str="default", timeout: float=None) -> List[List[dict]]:
+        try:
+            async def send(base_url: str, timeout: float):
+                async with self.get_session().post(
+                    base_url + f"/knowledge/{namespace}/search/batch",
+                    json={"queries": queries, "count": count},
+                    timeout=timeout
+                ) as resp:
+                    return (await resp.json())["results"]
+
+            return await self.requester.arequest(send, timeout or self.timeout)
+
+        except Exception as ex:
+            logger.error(f"Error at VSSEngine.search_many: {str(ex)}\n{traceback.format_exc()}")
+            raise ex
+
+    def search_many(self, queries: List[str], count: int=1, namespace: str="default", timeout: float=None) -> List[List[dict]]:
+        return self.sync(self.asearch_many(queries, count, namespace, timeout))
+
+    async def arebuild_index(self, index_factory: str=None, sample_size: int=None) -> dict:
+        try:
+            client_session = self.get_session()
+            async with client_session.post(
+                self.base_url + "/index/rebuild",
+                json={"index_factory": index_factory, "sample_size": sample_size},
+                timeout=None
+            ) as resp:
+                return await resp.json()
+
+        except Exception as ex:
+            logger.error(f"Error at VSSEngine.rebuild_index: {str(ex)}\n{traceback.format_exc()}")
+            raise ex
+
+    def rebuild_index(self, index_factory: str=None, sample_size: int=None) -> dict:
+        return self.sync(self.arebuild_index(index_factory, sample_size))
+
+    async def atrain_index(self, sample_size: int=None) -> dict:
+        try:
+            client_session = self.get_session()
+            async with client_session.post(
+                self.base_url + "/index/train",
+                json={"sample_size": sample_size},
+                timeout=None
+            ) as resp:
+                return await resp.json()
+
+        except Exception as ex:
+            logger.error(f"Error at VSSEngine.train_index: {str(ex)}\n{traceback.format_exc()}")
+            raise ex
+
+    def train_index(self, sample_size: int=None) -> dict:
+        return self.sync(self.atrain_index(sample_size))
 
     async def aload_records_as_json(self, path) -> List[dict]:
-        async with aiofiles.open(path, mode="r", newline="") as file:
-            content = await file.read()
-            try:
-                return json.loads(content)["records"]
-            except Exception as ex:
-                csv_lines = content.split("\n")
-                reader = csv.DictReader(csv_lines)
-                return [dict(r) for r in reader]
+        return [r async for r in aiter_records(path)]
 
-    async def aimport_file(self, path: str, body_key: str="body", namespace: str="default"):
-        records = await self.aload_records_as_json(path)
+    async def aimport_file(self, path: str, body_key: str="body", namespace: str="default", concurrency: int=4, batch_size: int=100, progress: Callable[[int], None]=None):
+        ids = {}
+        errors = {}
+        done = 0
+        semaphore = asyncio.Semaphore(concurrency)
+        tasks = set()
 
-        ret = {"ids": [], "errors": []}
-        for r in records:
+        async def import_one(i: int, r: dict):
             try:
                 if "id" in r:
-                    ret["ids"].append(await self.aupdate(r["id"], r[body_key], r))
+                    ids[i] = await self.aupdate(r["id"], r[body_key], r)
                 else:
-                    ret["ids"].append(await self.aadd(r[body_key], r, namespace))
+                    ids[i] = await self.aadd(r[body_key], r, namespace)
             except Exception as ex:
-                ret["errors"].append({"message": str(ex), "record": r})
+                errors[i] = {"message": str(ex), "record": r}
+
+        async def import_batch(batch: List[tuple]):
+            nonlocal done
+            try:
+                if len(batch) == 1:
+                    await import_one(*batch[0])
+                else:
+                    try:
+                        batch_ids = await self.aadd_many([r[body_key] for _, r in batch], [r for _, r in batch], namespace)
+                        ids.update(zip([i for i, _ in batch], batch_ids))
+                    except Exception as ex:
+                        if isinstance(ex, ClientResponseError) and 400 <= ex.status < 500:
+                            # Rejected without adding any records. Retry one by one to report which records failed
+                            for i, r in batch:
+                                await import_one(i, r)
+                        else:
+                            # Records may be added on timeouts or server errors. Report them instead of sending again
+                            for i, r in batch:
+                                errors[i] = {"message": str(ex), "record": r}
+                done += len(batch)
+                if progress:
+                    progress(done)
+            finally:
+                semaphore.release()
+
+        async def submit(batch: List[tuple]):
+            # Wait for a free slot before reading further not to hold the whole file
+            await semaphore.acquire()
+            task = asyncio.create_task(import_batch(batch))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        # Records with id are updated one by one and others are added in batches
+        pending = []
+        i = 0
+        async for r in aiter_records(path):
+            if body_key not in r:
+                # Report only this record instead of failing the whole batch
+                errors[i] = {"message": f"'{body_key}' not found", "record": r}
+                done += 1
+                if progress:
+                    progress(done)
+            elif "id" in r:
+                await submit([(i, r)])
+            else:
+                pending.append((i, r))
+                if len(pending) >= batch_size:
+                    await submit(pending)
+                    pending = []
+            i += 1
+        if pending:
+            await submit(pending)
+        await asyncio.gather(*tasks)
 
-        return ret
+        return {"ids": [ids[i] for i in sorted(ids)], "errors": [errors[i] for i in sorted(errors)]}
 
-    def import_file(self, path: str, body_key: str="body", namespace: str="default"):
-        return self.sync(self.aimport_file(path, body_key, namespace))
+    def import_file(self, path: str, body_key: str="body", namespace: str="default", concurrency: int=4, batch_size: int=100, progress: Callable[[int], None]=None):
+        return self.sync(self.aimport_file(path, body_key, namespace, concurrency, batch_size, progress))
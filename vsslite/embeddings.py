@@ -0,0 +1,177 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import re
+import threading
+from typing import List
+import unicodedata
+
+import numpy as np
+from openai import Embedding
+
+
+class EmbeddingCache:
+    # In-memory LRU tier of embeddings keyed by model and normalized text hash.
+    # Embeddings are kept as float32 arrays, about 1/8 of the size of float lists.
+    # The persistent tier is managed by the engine that owns the storage.
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "persistent_hits": 0, "misses": 0}
+
+    @staticmethod
+    def make_key(model_name: str, text: str) -> str:
+        normalized = " ".join(unicodedata.normalize("NFC", text).split())
+        return hashlib.sha256(f"{model_name}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> np.ndarray:
+        with self.lock:
+            embedding = self.items.get(key)
+            if embedding is not None:
+                self.items.move_to_end(key)
+                self.stats["memory_hits"] += 1
+            return embedding
+
+    def put(self, key: str, embedding: List[float]):
+        if self.max_size <= 0:
+            return
+
+        embedding = np.asarray(embedding, dtype=np.float32)
+        with self.lock:
+            self.items[key] = embedding
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def count(self, name: str, value: int = 1):
+        with self.lock:
+            self.stats[name] += value
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return dict(self.stats, size=len(self.items), max_size=self.max_size)
+
+
+class EmbeddingProvider:
+    model_name = None
+    dimension = None
+
+    def count_tokens(self, text: str) -> int:
+        # Rough estimation for providers without their own tokenizer
+        return len(text) // 4 + 1
+
+    async def aembed(self, texts: List[str]) -> List[List[float]]:
+        pass
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    def __init__(self, apikey: str, model_name: str = "text-embedding-ada-002", dimension: int = 1536):
+        self.apikey = apikey
+        self.model_name = model_name
+        self.dimension = dimension
+        self.tokenizer = None
+
+    def count_tokens(self, text: str) -> int:
+        if self.tokenizer is None:
+            import tiktoken
+            self.tokenizer = tiktoken.get_encoding("cl100k_base")
+        return len(self.tokenizer.encode(text, disallowed_special=()))
+
+    async def aembed(self, texts: List[str]) -> List[List[float]]:
+        response = await Embedding.acreate(
+            api_key=self.apikey,
+            engine=self.model_name,
+            input=texts
+        )
+        return [d["embedding"] for d in sorted(response["data"], key=lambda d: d["index"])]
+
+
+class HashingEmbeddingProvider(EmbeddingProvider):
+    # Deterministic local embeddings by feature hashing (a sparse random projection)
+    # of words and character n-grams. Useful for benchmarks and tests without API calls.
+    def __init__(self, dimension: int = 256, ngram_size: int = 3, seed: int = 0):
+        self.model_name = f"hashing-{dimension}-{ngram_size}-{seed}"
+        self.dimension = dimension
+        self.ngram_size = ngram_size
+        self.seed = seed.to_bytes(8, "little")
+
+    def count_tokens(self, text: str) -> int:
+        return len(text.split()) + 1
+
+    def get_features(self, text: str) -> List[str]:
+        words = re.findall(r"\w+", text.lower())
+        features = list(words)
+        for w in words:
+            padded = f"#{w}#"
+            features.extend(padded[i:i + self.ngram_size] for i in range(len(padded) - self.ngram_size + 1))
+        return features
+
+    def embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for f in self.get_features(text):
+            digest = hashlib.blake2b(f.encode("utf-8"), digest_size=8, key=self.seed).digest()
+            h = int.from_bytes(digest, "little")
+            vector[h % self.dimension] += 1.0 if (h >> 63) & 1 else -1.0
+
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector.tolist()
+
+    async def aembed(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed(t) for t in texts]
+
+
+class ONNXEmbeddingProvider(EmbeddingProvider):
+    # Sentence embeddings on CPU by a transformer model exported to ONNX
+    # (e.g. all-MiniLM-L6-v2) with mean pooling over the last hidden state.
+    def __init__(self, model_path: str, tokenizer_path: str, dimension: int = None, max_length: int = 256, intra_op_num_threads: int = 0):
+        try:
+            import onnxruntime
+            from tokenizers import Tokenizer
+        except ImportError:
+            raise ImportError("onnxruntime and tokenizers are required for ONNXEmbeddingProvider. Install them by `pip install onnxruntime tokenizers`.")
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_num_threads
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.enable_padding()
+
+        output_dimension = self.session.get_outputs()[0].shape[-1]
+        self.dimension = dimension or output_dimension
+        if not isinstance(self.dimension, int):
+            raise ValueError("dimension is required because it can't be determined from the model")
+
+        self.model_name = f"onnx-{model_path}"
+        # Inference is CPU-bound so run it off the event loop
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vsslite-onnx")
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer.encode(text).ids)
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        inputs = {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "token_type_ids": np.zeros_like(input_ids)
+        }
+        output = self.session.run(None, {k: v for k, v in inputs.items() if k in self.input_names})[0]
+
+        if output.ndim == 3:
+            mask = attention_mask[:, :, np.newaxis].astype(np.float32)
+            output = (output * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+        output = output / np.clip(np.linalg.norm(output, axis=1, keepdims=True), 1e-12, None)
+        return output.astype(np.float32).tolist()
+
+    async def aembed(self, texts: List[str]) -> List[List[float]]:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.embed, texts)
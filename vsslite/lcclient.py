@@ -1,17 +1,21 @@
 import asyncio
-import base64
-import csv
 from dataclasses import dataclass
 import json
 from logging import getLogger, NullHandler
 import os
+import threading
 import traceback
-from typing import List
+from typing import AsyncIterator, Callable, List
+import weakref
 
 import aiofiles
 import aiohttp
 from aiohttp.client_exceptions import ClientResponseError
 
+from .loop import run_sync
+from .records import aiter_records
+from .requester import ReplicaRequester
+
 logger = getLogger(__name__)
 logger.addHandler(NullHandler())
 
@@ -23,39 +27,105 @@ class Document:
 
 
 class LangChainVSSLiteClient:
-    def __init__(self, base_url: str = "http://127.0.0.1:8000", timeout=120):
-        self.base_url = base_url
+    def __init__(self, base_url: str = "http://127.0.0.1:8000", timeout=120, upload_chunk_size: int = 1024 * 1024, job_poll_interval: float = 1.0, connection_limit: int = 100, keepalive_timeout: float = 30, dns_ttl: int = 300, base_urls: List[str] = None, retry_count: int = 2, backoff_base: float = 0.1, backoff_max: float = 2.0, hedge: bool = False):
+        # Idempotent calls (get and search) are retried and optionally hedged across base_urls
+        self.base_url = base_urls[0] if base_urls else base_url
         self.timeout = timeout
+        self.requester = ReplicaRequester(base_urls or [base_url], retry_count, backoff_base, backoff_max, hedge)
+        self.upload_chunk_size = upload_chunk_size
+        self.job_poll_interval = job_poll_interval
+        self.connection_limit = connection_limit
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_ttl = dns_ttl
+        # Sessions are bound to the event loop that made them so keep one per loop
+        self.sessions = weakref.WeakKeyDictionary()
+        self.sessions_lock = threading.Lock()
 
     def sync(self, future):
-        return asyncio.get_event_loop().run_until_complete(future)
-
-    async def asearch(self, query: str, count: int = 4, namespace: str = "default", score_threshold: float = 0.0) -> List[dict]:
+        # Run on the shared background loop so that this works from any thread or inside running loops
+        return run_sync(future)
+
+    def get_session(self) -> aiohttp.ClientSession:
+        # Reuse a long-lived session per event loop to keep connections alive
+        loop = asyncio.get_running_loop()
+        with self.sessions_lock:
+            session = self.sessions.get(loop)
+            if session is None or session.closed:
+                # Sessions refer to their loop so entries of closed loops don't vanish by themselves
+                for closed_loop in [l for l in self.sessions if l.is_closed()]:
+                    del self.sessions[closed_loop]
+                session = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(
+                        limit=self.connection_limit,
+                        keepalive_timeout=self.keepalive_timeout,
+                        ttl_dns_cache=self.dns_ttl
+                    ),
+                    raise_for_status=True
+                )
+                self.sessions[loop] = session
+            return session
+
+    async def aclose(self):
+        current_loop = asyncio.get_running_loop()
+        with self.sessions_lock:
+            sessions = list(self.sessions.items())
+            self.sessions.clear()
+
+        for loop, session in sessions:
+            if session.closed or loop.is_closed():
+                continue
+            if loop is current_loop:
+                await session.close()
+            elif loop.is_running():
+                # Close on the loop that owns the session without waiting for it.
+                # That loop may be blocked by sync close() and runs this when it resumes
+                asyncio.run_coroutine_threadsafe(session.close(), loop)
+
+    def close(self):
+        self.sync(self.aclose())
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        await self.aclose()
+
+    async def asearch(self, query: str, count: int = 4, namespace: str = "default", score_threshold: float = 0.0, where: dict = None, mmr: bool = False, fetch_k: int = 20, lambda_mult: float = 0.5, timeout: float = None) -> List[dict]:
         try:
-            async with aiohttp.ClientSession(raise_for_status=True) as client_session:
-                async with client_session.get(
-                    self.base_url + f"/search/{namespace}",
-                    params={"q": query, "count": count, "score_threshold": score_threshold},
-                    timeout=self.timeout
+            params = {"q": query, "count": count, "score_threshold": score_threshold}
+            if where:
+                params["where"] = json.dumps(where)
+            if mmr:
+                params.update({"mmr": "true", "fetch_k": fetch_k, "lambda_mult": lambda_mult})
+
+            async def send(base_url: str, timeout: float):
+                async with self.get_session().get(
+                    base_url + f"/search/{namespace}",
+                    params=params,
+                    timeout=timeout
                 ) as resp:
                     return (await resp.json())["results"]
 
+            return await self.requester.arequest(send, timeout or self.timeout)
+
         except Exception as ex:
             logger.error(f"Error at VSSClient.search: {str(ex)}\n{traceback.format_exc()}")
             raise ex
 
-    def search(self, query: str, count: int = 4, namespace: str = "default") -> List[dict]:
-        return self.sync(self.asearch(query, count, namespace))
+    def search(self, query: str, count: int = 4, namespace: str = "default", score_threshold: float = 0.0, where: dict = None, mmr: bool = False, fetch_k: int = 20, lambda_mult: float = 0.5, timeout: float = None) -> List[dict]:
+        return self.sync(self.asearch(query, count, namespace, score_threshold, where, mmr, fetch_k, lambda_mult, timeout))
 
-    async def aget(self, id: str, namespace: str = "default") -> dict:
+    async def aget(self, id: str, namespace: str = "default", timeout: float = None) -> dict:
         try:
-            async with aiohttp.ClientSession(raise_for_status=True) as client_session:
-                async with client_session.get(
-                    self.base_url + f"/document/{namespace}/{id}",
-                    timeout=self.timeout
+            async def send(base_url: str, timeout: float):
+                async with self.get_session().get(
+                    base_url + f"/document/{namespace}/{id}",
+                    timeout=timeout
                 ) as resp:
                     return await resp.json()
 
+            return await self.requester.arequest(send, timeout or self.timeout)
+
         except ClientResponseError as crerr:
             if crerr.status == 404:
                 return None
@@ -65,24 +135,39 @@ class LangChainVSSLiteClient:
             logger.error(f"Error at VSSClient.get: {str(ex)}\n{traceback.format_exc()}")
             raise ex
 
-    def get(self, id: str, namespace: str = "default") -> dict:
-        return self.sync(self.aget(id, namespace))
+    def get(self, id: str, namespace: str = "default", timeout: float = None) -> dict:
+        return self.sync(self.aget(id, namespace, timeout))
 
-    async def aget_all(self, namespace: str = "default") -> List[dict]:
+    async def aiter_all(self, namespace: str = "default", page_size: int = 1000) -> AsyncIterator[dict]:
+        # Fetch documents page by page and yield them one by one
         try:
-            async with aiohttp.ClientSession(raise_for_status=True) as client_session:
+            client_session = self.get_session()
+            offset = 0
+            while offset is not None:
                 async with client_session.get(
                     self.base_url + f"/document/{namespace}/all",
+                    params={"limit": page_size, "offset": offset},
                     timeout=self.timeout
                 ) as resp:
-                    return await resp.json()
+                    page = await resp.json()
+
+                for id, d in zip(page["ids"], page["documents"]):
+                    yield {"id": id, "page_content": d["page_content"], "metadata": d["metadata"]}
+                offset = page.get("next_offset")
 
         except Exception as ex:
-            logger.error(f"Error at VSSClient.get: {str(ex)}\n{traceback.format_exc()}")
+            logger.error(f"Error at VSSClient.iter_all: {str(ex)}\n{traceback.format_exc()}")
             raise ex
 
-    def get_all(self, namespace: str = "default") -> List[dict]:
-        return self.sync(self.aget_all(namespace))
+    async def aget_all(self, namespace: str = "default", page_size: int = 1000) -> List[dict]:
+        ret = {"ids": [], "documents": []}
+        async for d in self.aiter_all(namespace, page_size):
+            ret["ids"].append(d["id"])
+            ret["documents"].append({"page_content": d["page_content"], "metadata": d["metadata"]})
+        return ret
+
+    def get_all(self, namespace: str = "default", page_size: int = 1000) -> List[dict]:
+        return self.sync(self.aget_all(namespace, page_size))
 
     async def aadd(self, documents: List[Document], namespace: str = "default") -> List[str]:
         try:
@@ -91,20 +176,21 @@ class LangChainVSSLiteClient:
             else:
                 _documents = documents
 
-            async with aiohttp.ClientSession(raise_for_status=True) as client_session:
-                async with client_session.post(
-                    self.base_url + f"/document/{namespace}",
-                    json={"documents": [
-                        {"page_content": d.page_content, "metadata": d.metadata}
-                        for d in _documents]
-                    },
-                    timeout=self.timeout
-                ) as resp:
-                    ids = (await resp.json())["ids"]
-                    if isinstance(documents, str):
-                        return ids[0]
-                    else:
-                        return ids
+            client_session = self.get_session()
+            async with client_session.post(
+                self.base_url + f"/document/{namespace}",
+                json={"documents": [
+                    {"page_content": d.page_content, "metadata": d.metadata}
+                    for d in _documents]
+                },
+                timeout=self.timeout
+            ) as resp:
+                ids = (await resp.json())["ids"]
+                if isinstance(documents, str):
+                    # None when skipped as a duplicate
+                    return ids[0] if ids else None
+                else:
+                    return ids
 
         except Exception as ex:
             logger.error(f"Error at VSSEngine.add: {str(ex)}\n{traceback.format_exc()}")
@@ -125,18 +211,18 @@ class LangChainVSSLiteClient:
             else:
                 _documents = documents
 
-            async with aiohttp.ClientSession(raise_for_status=True) as client_session:
-                async with client_session.patch(
-                    self.base_url + f"/document/{namespace}",
-                    json={
-                        "ids": _ids,
-                        "documents": [
-                            {"page_content": d.page_content, "metadata": d.metadata}
-                        for d in _documents]
-                    },
-                    timeout=self.timeout
-                ):
-                    pass
+            client_session = self.get_session()
+            async with client_session.patch(
+                self.base_url + f"/document/{namespace}",
+                json={
+                    "ids": _ids,
+                    "documents": [
+                        {"page_content": d.page_content, "metadata": d.metadata}
+                    for d in _documents]
+                },
+                timeout=self.timeout
+            ):
+                pass
 
         except Exception as ex:
             logger.error(f"Error at VSSEngine.update: {str(ex)}\n{traceback.format_exc()}")
@@ -145,43 +231,90 @@ class LangChainVSSLiteClient:
     def update(self, ids: List[str], documents: List[Document], namespace: str = "default"):
         self.sync(self.aupdate(ids, documents, namespace))
 
-    async def aupload(self, path: str, loader_params: dict = None, namespace: str = "default") -> List[str]:
+    async def apost_file(self, path: str, loader_params: dict = None, namespace: str = "default", background: bool = False) -> dict:
         try:
-            async with aiofiles.open(path, "rb") as file:
-                binary_data = await file.read()
-
-            b64content = base64.b64encode(binary_data).decode("utf-8")
             filename = os.path.basename(path)
             document_type = os.path.splitext(filename)[1]
+            params = {"filename": filename, "document_type": document_type, "background": "true" if background else "false"}
+            if loader_params:
+                params["loader_params"] = json.dumps(loader_params)
+
+            async def read_chunks():
+                # Stream the file as the request body not to load it into memory at once
+                async with aiofiles.open(path, "rb") as file:
+                    while chunk := await file.read(self.upload_chunk_size):
+                        yield chunk
+
+            client_session = self.get_session()
+            async with client_session.post(
+                self.base_url + f"/document/{namespace}/upload/stream",
+                params=params,
+                data=read_chunks(),
+                headers={"Content-Type": "application/octet-stream"},
+                timeout=self.timeout
+            ) as resp:
+                return await resp.json()
 
-            async with aiohttp.ClientSession(raise_for_status=True) as client_session:
-                async with client_session.post(
-                    self.base_url + f"/document/{namespace}/upload",
-                    json={
-                        "b64content": b64content,
-                        "filename": filename,
-                        "document_type": document_type,
-                        "loader_params": loader_params
-                    },
-                    timeout=self.timeout
-                ) as resp:
-                    return (await resp.json())["ids"]
+        except Exception as ex:
+            logger.error(f"Error at VSSClient.upload: {str(ex)}\n{traceback.format_exc()}")
+            raise ex
+
+    async def aupload_background(self, path: str, loader_params: dict = None, namespace: str = "default") -> str:
+        return (await self.apost_file(path, loader_params, namespace, True))["job_id"]
+
+    def upload_background(self, path: str, loader_params: dict = None, namespace: str = "default") -> str:
+        return self.sync(self.aupload_background(path, loader_params, namespace))
+
+    async def aget_job(self, job_id: str) -> dict:
+        try:
+            client_session = self.get_session()
+            async with client_session.get(
+                self.base_url + f"/jobs/{job_id}",
+                timeout=self.timeout
+            ) as resp:
+                return await resp.json()
+
+        except ClientResponseError as crerr:
+            if crerr.status == 404:
+                return None
+            logger.error(f"Error at VSSClient.get_job: {str(crerr)}\n{traceback.format_exc()}")
+            raise crerr
 
         except Exception as ex:
-            logger.error(f"Error at VSSClient.aupload: {str(ex)}\n{traceback.format_exc()}")
+            logger.error(f"Error at VSSClient.get_job: {str(ex)}\n{traceback.format_exc()}")
             raise ex
 
-    def upload(self, path: str, loader_params: dict = None, namespace: str = "default") -> List[str]:
-        return self.sync(self.aupload(path, loader_params, namespace))
+    def get_job(self, job_id: str) -> dict:
+        return self.sync(self.aget_job(job_id))
+
+    async def aupload(self, path: str, loader_params: dict = None, namespace: str = "default", background: bool = False) -> List[str]:
+        if not background:
+            return (await self.apost_file(path, loader_params, namespace))["ids"]
+
+        # Upload in background and poll the job not to hit the timeout with large documents.
+        # Jobs are kept in the server process so this requires a single worker or sticky routing
+        job_id = await self.aupload_background(path, loader_params, namespace)
+        while True:
+            job = await self.aget_job(job_id)
+            if job is None:
+                raise Exception(f"Ingestion job {job_id} not found")
+            if job["status"] == "completed":
+                return job["ids"]
+            if job["status"] == "failed":
+                raise Exception(f"Ingestion job {job_id} failed: {job['errors']}")
+            await asyncio.sleep(self.job_poll_interval)
+
+    def upload(self, path: str, loader_params: dict = None, namespace: str = "default", background: bool = False) -> List[str]:
+        return self.sync(self.aupload(path, loader_params, namespace, background))
 
     async def adelete(self, id: str, namespace: str = "default"):
         try:
-            async with aiohttp.ClientSession(raise_for_status=True) as client_session:
-                async with client_session.delete(
-                    self.base_url + f"/document/{namespace}/{id}",
-                    timeout=self.timeout
-                ):
-                    pass
+            client_session = self.get_session()
+            async with client_session.delete(
+                self.base_url + f"/document/{namespace}/{id}",
+                timeout=self.timeout
+            ):
+                pass
 
         except Exception as ex:
             logger.error(f"Error at VSSClient.delete: {str(ex)}\n{traceback.format_exc()}")
@@ -192,12 +325,12 @@ class LangChainVSSLiteClient:
 
     async def adelete_all(self, namespace: str = "default"):
         try:
-            async with aiohttp.ClientSession(raise_for_status=True) as client_session:
-                async with client_session.delete(
-                    self.base_url + f"/document/{namespace}/all",
-                    timeout=self.timeout
-                ):
-                    pass
+            client_session = self.get_session()
+            async with client_session.delete(
+                self.base_url + f"/document/{namespace}/all",
+                timeout=self.timeout
+            ):
+                pass
 
         except Exception as ex:
             logger.error(f"Error at VSSClient.delete_all: {str(ex)}\n{traceback.format_exc()}")
@@ -207,31 +340,85 @@ class LangChainVSSLiteClient:
         self.sync(self.adelete_all(namespace))
 
     async def aload_records_as_json(self, path) -> List[dict]:
-        async with aiofiles.open(path, mode="r", newline="") as file:
-            content = await file.read()
-            try:
-                return json.loads(content)["records"]
-            except Exception:
-                csv_lines = content.split("\n")
-                reader = csv.DictReader(csv_lines)
-                return [dict(r) for r in reader]
-
-    async def aimport_file(self, path: str, content_key: str = "page_content", namespace: str = "default") -> dict:
-        records = await self.aload_records_as_json(path)
+        return [r async for r in aiter_records(path)]
+
+    async def aimport_file(self, path: str, content_key: str = "page_content", namespace: str = "default", concurrency: int = 4, batch_size: int = 100, progress: Callable[[int], None] = None) -> dict:
+        ids = {}
+        errors = {}
+        duplicates = []
+        done = 0
+        semaphore = asyncio.Semaphore(concurrency)
+        tasks = set()
+
+        async def import_records(batch: List[tuple]):
+            documents = [Document(page_content=r[content_key], metadata=r) for _, r in batch]
+            if "id" in batch[0][1]:
+                await self.aupdate([r["id"] for _, r in batch], documents, namespace)
+                ids.update((i, r["id"]) for i, r in batch)
+            else:
+                # Ids are in the order of documents and None for duplicates
+                for (i, _), id in zip(batch, await self.aadd(documents, namespace)):
+                    if id is None:
+                        duplicates.append(i)
+                    else:
+                        ids[i] = id
 
-        ret = {"ids": [], "errors": []}
-        for r in records:
+        async def import_batch(batch: List[tuple]):
+            nonlocal done
             try:
-                page_content = r[content_key]
-                if "id" in r:
-                    await self.aupdate([r["id"]], [Document(page_content=page_content, metadata=r)], namespace)
-                    ret["ids"].append(r["id"])
-                else:
-                    ret["ids"].append((await self.aadd([Document(page_content=page_content, metadata=r)], namespace))[0])
-            except Exception as ex:
-                ret["errors"].append({"message": str(ex), "record": r})
-
-        return ret
-
-    def import_file(self, path: str, content_key: str = "content", namespace: str = "default") -> dict:
-        return self.sync(self.aimport_file(path, content_key, namespace))
+                try:
+                    await import_records(batch)
+                except Exception as ex:
+                    if "id" in batch[0][1] or isinstance(ex, ClientResponseError) and 400 <= ex.status < 500:
+                        # Updates can be sent again and rejected adds are not stored.
+                        # Retry one by one to report which records failed
+                        for i, r in batch:
+                            try:
+                                await import_records([(i, r)])
+                            except Exception as record_ex:
+                                errors[i] = {"message": str(record_ex), "record": r}
+                    else:
+                        # Documents may be added on timeouts or server errors. Report them instead of sending again
+                        for i, r in batch:
+                            errors[i] = {"message": str(ex), "record": r}
+                done += len(batch)
+                if progress:
+                    progress(done)
+            finally:
+                semaphore.release()
+
+        async def submit(batch: List[tuple]):
+            # Wait for a free slot before reading further not to hold the whole file
+            await semaphore.acquire()
+            task = asyncio.create_task(import_batch(batch))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        # Send records in batches with or without id separately to update or add them at once
+        updates = []
+        adds = []
+        i = 0
+        async for r in aiter_records(path):
+            if content_key not in r:
+                # Report only this record instead of failing the whole batch
+                errors[i] = {"message": f"'{content_key}' not found", "record": r}
+                done += 1
+                if progress:
+                    progress(done)
+                i += 1
+                continue
+            pending = updates if "id" in r else adds
+            pending.append((i, r))
+            if len(pending) >= batch_size:
+                await submit(pending[:])
+                pending.clear()
+            i += 1
+        for pending in (updates, adds):
+            if pending:
+                await submit(pending)
+        await asyncio.gather(*tasks)
+
+        return {"ids": [ids[i] for i in sorted(ids)], "errors": [errors[i] for i in sorted(errors)], "duplicates": sorted(duplicates)}
+
+    def import_file(self, path: str, content_key: str = "content", namespace: str = "default", concurrency: int = 4, batch_size: int = 100, progress: Callable[[int], None] = None) -> dict:
+        return self.sync(self.aimport_file(path, content_key, namespace, concurrency, batch_size, progress))
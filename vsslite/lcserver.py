@@ -1,25 +1,503 @@
+import asyncio
 import base64
+from collections import OrderedDict
+from contextlib import contextmanager
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
 from logging import getLogger
+import json
+import multiprocessing
 import os
+import tempfile
+import threading
 import traceback
-from typing import List, Optional
+from typing import Any, Awaitable, Callable, Iterator, List, Optional
+import unicodedata
+from uuid import uuid4
 
 import aiofiles
-from fastapi import FastAPI
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
 
 from langchain.schema import Document as LDocument
 from langchain.schema.embeddings import Embeddings
 from langchain.document_loaders import PDFMinerLoader, TextLoader, CSVLoader, JSONLoader
+from langchain.document_loaders.base import BaseLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.embeddings import OpenAIEmbeddings
 from langchain.vectorstores.chroma import Chroma
+import numpy as np
+from pdfminer.high_level import extract_text
+from pdfminer.pdfpage import PDFPage
 
 
 logger = getLogger(__name__)
 
 
+def make_loader(path: str, document_type: str, loader_params: dict = None) -> BaseLoader:
+    loader_params = loader_params or {}
+
+    if document_type.lower() == ".pdf":
+        return PDFMinerLoader(path, **loader_params)
+    elif document_type.lower() == ".txt":
+        return TextLoader(path, **loader_params)
+    elif document_type.lower() == ".csv":
+        return CSVLoader(path, **loader_params)
+    elif document_type.lower() == ".json":
+        return JSONLoader(path, **loader_params)
+    else:
+        return None
+
+
+# Functions below run in loader processes so they must be picklable module-level functions
+def load_documents(path: str, document_type: str, loader_params: dict = None) -> List[LDocument]:
+    return make_loader(path, document_type, loader_params).load()
+
+
+def count_pdf_pages(path: str) -> int:
+    with open(path, "rb") as file:
+        return sum(1 for _ in PDFPage.get_pages(file))
+
+
+def extract_pdf_text(path: str, page_numbers: List[int]) -> str:
+    return extract_text(path, page_numbers=page_numbers)
+
+
+class ChromaExecutor:
+    # Chroma calls are blocking so they run on a thread pool instead of the event loop, and
+    # CPU-bound document parsing runs on a process pool not to hold the GIL.
+    # Writes to the same namespace are serialized while reads and other namespaces run concurrently.
+    def __init__(self, worker_count: int = 4, loader_worker_count: int = 2):
+        self.workers = ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix="vsslite-chroma")
+        # Forking the threaded server may copy locks held by other threads. Start loaders fresh instead.
+        # Spawned loaders import the main script again, so scripts that run the server need the __main__ guard
+        self.loaders = ProcessPoolExecutor(max_workers=loader_worker_count, mp_context=multiprocessing.get_context("spawn"))
+        self.write_locks = {}
+
+    async def aread(self, func: Callable, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self.workers, func, *args)
+
+    async def awrite(self, namespace: str, func: Callable, *args) -> Any:
+        lock = self.write_locks.setdefault(namespace, asyncio.Lock())
+        async with lock:
+            return await asyncio.get_running_loop().run_in_executor(self.workers, func, *args)
+
+    async def aload(self, func: Callable, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self.loaders, func, *args)
+
+    def shutdown(self):
+        self.workers.shutdown(wait=True)
+        self.loaders.shutdown(wait=True)
+
+
+class VectorStoreRegistry:
+    # LRU registry of open Chroma stores per namespace to avoid reopening the
+    # persistent client and collection on every request.
+    # Stores are reference counted while in use and closed when evicted and released.
+    def __init__(self, persist_directory: str, embedding_function: Embeddings, max_size: int = 100):
+        self.persist_directory = persist_directory
+        self.embedding_function = embedding_function
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.refs = {}
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "opens": 0, "evictions": 0, "closes": 0}
+
+    def open(self, namespace: str) -> Chroma:
+        return Chroma(
+            persist_directory=os.path.join(self.persist_directory, namespace),
+            embedding_function=self.embedding_function
+        )
+
+    def close(self, store: Chroma):
+        try:
+            # Each Chroma store has its own chromadb client and system. Stop it to release
+            # the sqlite connections and executors of the system.
+            store._client._system.stop()
+            with self.lock:
+                self.stats["closes"] += 1
+        except Exception as ex:
+            logger.warning(f"Error at closing vector store: {ex}")
+
+    def acquire(self, namespace: str = "default") -> Chroma:
+        # Release the store after use so that it can be closed when evicted
+        evicted = []
+        with self.lock:
+            store = self.items.get(namespace)
+            if store is not None:
+                self.items.move_to_end(namespace)
+                self.stats["hits"] += 1
+            else:
+                store = self.open(namespace)
+                self.stats["opens"] += 1
+                if self.max_size > 0:
+                    self.items[namespace] = store
+                    while len(self.items) > self.max_size:
+                        s = self.items.popitem(last=False)[1]
+                        self.stats["evictions"] += 1
+                        if s not in self.refs:
+                            evicted.append(s)
+            self.refs[store] = self.refs.get(store, 0) + 1
+
+        for s in evicted:
+            self.close(s)
+
+        return store
+
+    def release(self, namespace: str, store: Chroma):
+        with self.lock:
+            self.refs[store] -= 1
+            if self.refs[store] > 0:
+                return
+            del self.refs[store]
+            if self.items.get(namespace) is store:
+                return
+
+        # Evicted, discarded or not cached while in use
+        self.close(store)
+
+    @contextmanager
+    def use(self, namespace: str = "default") -> Iterator[Chroma]:
+        store = self.acquire(namespace)
+        try:
+            yield store
+        finally:
+            self.release(namespace, store)
+
+    def discard(self, namespace: str):
+        # Forget the store so that the next use reopens the collection. It is closed when not in use
+        with self.lock:
+            store = self.items.pop(namespace, None)
+            if store is None or store in self.refs:
+                return
+
+        self.close(store)
+
+    def close_all(self):
+        with self.lock:
+            stores = list(self.items.values())
+            self.items.clear()
+
+        for s in stores:
+            self.close(s)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return dict(self.stats, size=len(self.items), in_use=len(self.refs), max_size=self.max_size)
+
+
+class ChunkDeduplicator:
+    # Skip chunks already stored in the namespace, by normalized content hash (exact)
+    # or additionally by embedding distance to the nearest stored chunk (near).
+    def __init__(self, mode: str = "exact", near_threshold: float = 0.05):
+        if mode not in ("exact", "near"):
+            raise ValueError(f"Unsupported dedup mode: {mode}")
+        self.mode = mode
+        self.near_threshold = near_threshold
+
+    @staticmethod
+    def make_content_hash(text: str) -> str:
+        normalized = " ".join(unicodedata.normalize("NFC", text).split()).lower()
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def filter_exact(self, collection, documents: List[LDocument], excluded_ids: List[str] = None) -> List[int]:
+        # Returns indices of unique documents and sets content_hash to their metadata
+        hashes = []
+        for d in documents:
+            d.metadata["content_hash"] = self.make_content_hash(d.page_content)
+            hashes.append(d.metadata["content_hash"])
+
+        excluded_ids = set(excluded_ids or [])
+        seen = set()
+        unique_hashes = list(set(hashes))
+        for i in range(0, len(unique_hashes), 500):
+            stored = collection.get(where={"content_hash": {"$in": unique_hashes[i:i + 500]}}, include=["metadatas"])
+            seen.update(m["content_hash"] for id, m in zip(stored["ids"], stored["metadatas"]) if id not in excluded_ids)
+
+        indices = []
+        for i, h in enumerate(hashes):
+            if h not in seen:
+                seen.add(h)
+                indices.append(i)
+        return indices
+
+    def filter_near(self, collection, embeddings: List[List[float]], excluded_ids: List[str] = None) -> List[int]:
+        # Returns indices of embeddings farther than near_threshold (squared L2) from stored and preceding ones
+        if self.mode != "near" or not embeddings:
+            return list(range(len(embeddings)))
+
+        excluded_ids = set(excluded_ids or [])
+        duplicated = set()
+        if collection.count() > 0:
+            nearest = collection.query(query_embeddings=embeddings, n_results=1, include=["distances"])
+            for i, (ids, distances) in enumerate(zip(nearest["ids"], nearest["distances"])):
+                if ids and ids[0] not in excluded_ids and distances[0] <= self.near_threshold:
+                    duplicated.add(i)
+
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        indices = []
+        for i in range(len(vectors)):
+            if i in duplicated:
+                continue
+            if indices:
+                d = vectors[indices] - vectors[i]
+                if float(np.min(np.einsum("ij,ij->i", d, d))) <= self.near_threshold:
+                    continue
+            indices.append(i)
+        return indices
+
+
+class IngestionQueue:
+    # Uploads run as background jobs pipelined through load, embed and write stages
+    # so that a job can be embedded while others are being loaded or written.
+    def __init__(self, executor: ChromaExecutor, vector_stores: VectorStoreRegistry, embedding_function: Embeddings, worker_count: int = 2, batch_size: int = 100, batch_tokens: int = 50000, max_in_flight_batches: int = 4, max_jobs: int = 1000, deduplicator: ChunkDeduplicator = None):
+        self.executor = executor
+        self.deduplicator = deduplicator
+        self.vector_stores = vector_stores
+        self.embedding_function = embedding_function
+        self.worker_count = worker_count
+        self.batch_size = batch_size
+        self.batch_tokens = batch_tokens
+        self.max_in_flight_batches = max_in_flight_batches
+        self.max_jobs = max_jobs
+        self.tokenizer = None
+        # Embedding requests are blocking so they run on their own pool not to occupy Chroma workers
+        self.embedders = ThreadPoolExecutor(max_workers=max_in_flight_batches, thread_name_prefix="vsslite-embedding")
+        self.jobs = OrderedDict()
+        self.futures = {}
+        self.chunk_ids = {}
+        self.stale_ids = {}
+        self.tasks = []
+
+    def start(self):
+        # Queues and workers are bound to the running loop so they are made on the first submit
+        if self.tasks:
+            return
+
+        self.load_queue = asyncio.Queue()
+        # Bound in-flight batches so that loading doesn't run too far ahead of embedding
+        self.embed_queue = asyncio.Queue(maxsize=self.max_in_flight_batches)
+        self.write_queue = asyncio.Queue(maxsize=self.max_in_flight_batches)
+        for _ in range(self.worker_count):
+            self.tasks.append(asyncio.create_task(self.load_worker()))
+            self.tasks.append(asyncio.create_task(self.write_worker()))
+        for _ in range(self.max_in_flight_batches):
+            self.tasks.append(asyncio.create_task(self.embed_worker()))
+
+    async def stop(self):
+        for t in self.tasks:
+            t.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks.clear()
+        self.embedders.shutdown(wait=True)
+
+    def count_tokens(self, text: str) -> int:
+        if self.tokenizer is None:
+            import tiktoken
+            self.tokenizer = tiktoken.get_encoding("cl100k_base")
+        return len(self.tokenizer.encode(text, disallowed_special=()))
+
+    def make_batches(self, documents: List[LDocument]) -> List[tuple]:
+        # Group documents so that each batch fits in a single embedding request
+        batches = []
+        start = 0
+        batch_tokens = 0
+        for i, d in enumerate(documents):
+            tokens = self.count_tokens(d.page_content)
+            if i > start and (i - start >= self.batch_size or batch_tokens + tokens > self.batch_tokens):
+                batches.append((start, documents[start:i]))
+                start = i
+                batch_tokens = 0
+            batch_tokens += tokens
+
+        if start < len(documents):
+            batches.append((start, documents[start:]))
+
+        return batches
+
+    def submit(self, namespace: str, filename: str, load: Callable[[], Awaitable[List[LDocument]]]) -> dict:
+        job = {
+            "id": str(uuid4()),
+            "namespace": namespace,
+            "filename": filename,
+            "status": "queued",
+            "chunk_count": None,
+            "embedded_count": 0,
+            "written_count": 0,
+            "failed_count": 0,
+            "unchanged_count": 0,
+            "deleted_count": 0,
+            "duplicate_count": 0,
+            "ids": [],
+            "errors": [],
+            "created_at": datetime.utcnow().isoformat(),
+            "finished_at": None
+        }
+        self.start()
+        self.jobs[job["id"]] = job
+        self.futures[job["id"]] = asyncio.get_running_loop().create_future()
+        self.chunk_ids[job["id"]] = {}
+
+        # Forget the oldest finished jobs
+        for id in [id for id, j in self.jobs.items() if j["finished_at"]][:max(0, len(self.jobs) - self.max_jobs)]:
+            del self.jobs[id]
+
+        self.load_queue.put_nowait((job, load))
+        return job
+
+    def get(self, id: str) -> dict:
+        return self.jobs.get(id)
+
+    async def wait(self, id: str) -> dict:
+        future = self.futures.get(id)
+        if future:
+            await asyncio.shield(future)
+        return self.jobs.get(id)
+
+    @staticmethod
+    def make_chunk_hash(document: LDocument) -> str:
+        metadata = {k: v for k, v in document.metadata.items() if k != "chunk_hash"}
+        return hashlib.sha256(f"{document.page_content}\0{json.dumps(metadata, sort_keys=True)}".encode("utf-8")).hexdigest()
+
+    def diff_chunks(self, namespace: str, filename: str, documents: List[LDocument]) -> tuple:
+        # Compare chunks with the manifest of the source, that is, chunk hashes stored in metadata
+        existing = {}
+        with self.vector_stores.use(namespace) as store:
+            stored = store._collection.get(where={"source": filename}, include=["metadatas"])
+        for id, metadata in zip(stored["ids"], stored["metadatas"]):
+            existing.setdefault((metadata or {}).get("chunk_hash"), []).append(id)
+
+        kept_ids = {}
+        new_positions = []
+        for i, d in enumerate(documents):
+            d.metadata["chunk_hash"] = self.make_chunk_hash(d)
+            if existing.get(d.metadata["chunk_hash"]):
+                kept_ids[i] = existing[d.metadata["chunk_hash"]].pop()
+            else:
+                new_positions.append(i)
+
+        stale_ids = [id for ids in existing.values() for id in ids]
+        return kept_ids, new_positions, stale_ids
+
+    async def complete(self, job: dict):
+        # Delete vanished chunks after new ones are written so that the source is always searchable
+        stale_ids = self.stale_ids.pop(job["id"], [])
+        if stale_ids and not job["errors"]:
+            try:
+                with self.vector_stores.use(job["namespace"]) as store:
+                    await self.executor.awrite(job["namespace"], store._collection.delete, stale_ids)
+                job["deleted_count"] = len(stale_ids)
+            except Exception as ex:
+                logger.error(f"Error at ingestion job {job['id']}: {ex}\n{traceback.format_exc()}")
+                job["errors"].append(str(ex))
+        self.finish(job)
+
+    def finish(self, job: dict):
+        chunk_ids = self.chunk_ids.pop(job["id"], {})
+        self.stale_ids.pop(job["id"], None)
+        job["ids"] = [chunk_ids[i] for i in sorted(chunk_ids)]
+        job["status"] = "failed" if job["errors"] else "completed"
+        job["finished_at"] = datetime.utcnow().isoformat()
+        future = self.futures.pop(job["id"], None)
+        if future and not future.done():
+            future.set_result(job)
+
+    def fail_batch(self, job: dict, count: int, ex: Exception):
+        logger.error(f"Error at ingestion job {job['id']}: {ex}\n{traceback.format_exc()}")
+        job["errors"].append(str(ex))
+        job["failed_count"] += count
+        if self.is_done(job):
+            self.finish(job)
+
+    @staticmethod
+    def is_done(job: dict) -> bool:
+        return job["written_count"] + job["failed_count"] + job["duplicate_count"] >= job["chunk_count"]
+
+    async def load_worker(self):
+        while True:
+            job, load = await self.load_queue.get()
+            try:
+                job["status"] = "loading"
+                documents = await load()
+                kept_ids, new_positions, stale_ids = await self.executor.aread(self.diff_chunks, job["namespace"], job["filename"], documents)
+                self.chunk_ids[job["id"]].update(kept_ids)
+                self.stale_ids[job["id"]] = stale_ids
+                job["unchanged_count"] = len(kept_ids)
+                documents = [documents[i] for i in new_positions]
+                job["chunk_count"] = len(documents)
+
+                if self.deduplicator and documents:
+                    # Skip exact duplicates not to embed them. They are checked again when written
+                    with self.vector_stores.use(job["namespace"]) as store:
+                        indices = await self.executor.aread(self.deduplicator.filter_exact, store._collection, documents, stale_ids)
+                    job["duplicate_count"] = len(documents) - len(indices)
+                    documents = [documents[i] for i in indices]
+                    new_positions = [new_positions[i] for i in indices]
+
+                if not documents:
+                    await self.complete(job)
+                    continue
+
+                batches = await self.executor.aread(self.make_batches, documents)
+                job["status"] = "embedding"
+                for index, batch in batches:
+                    await self.embed_queue.put((job, new_positions[index:index + len(batch)], batch))
+
+            except Exception as ex:
+                job["chunk_count"] = job["chunk_count"] or 0
+                self.fail_batch(job, 0, ex)
+
+    async def embed_worker(self):
+        while True:
+            job, positions, documents = await self.embed_queue.get()
+            try:
+                embeddings = await asyncio.get_running_loop().run_in_executor(
+                    self.embedders, self.embedding_function.embed_documents, [d.page_content for d in documents]
+                )
+                job["embedded_count"] += len(documents)
+                await self.write_queue.put((job, positions, documents, embeddings))
+
+            except Exception as ex:
+                self.fail_batch(job, len(documents), ex)
+
+    def write_documents(self, collection, job: dict, documents: List[LDocument], embeddings: List[List[float]]) -> dict:
+        # Runs under the write lock of the namespace so that duplicates are checked against all chunks
+        # accepted so far, including other batches of the same upload and concurrent uploads
+        indices = list(range(len(documents)))
+        if self.deduplicator:
+            stale_ids = self.stale_ids.get(job["id"])
+            indices = self.deduplicator.filter_exact(collection, documents, stale_ids)
+            indices = [indices[i] for i in self.deduplicator.filter_near(collection, [embeddings[i] for i in indices], stale_ids)]
+
+        ids = {i: str(uuid4()) for i in indices}
+        if ids:
+            collection.upsert(
+                list(ids.values()),
+                [embeddings[i] for i in ids],
+                [documents[i].metadata for i in ids],
+                [documents[i].page_content for i in ids]
+            )
+        return ids
+
+    async def write_worker(self):
+        while True:
+            job, positions, documents, embeddings = await self.write_queue.get()
+            try:
+                with self.vector_stores.use(job["namespace"]) as store:
+                    ids = await self.executor.awrite(job["namespace"], self.write_documents, store._collection, job, documents, embeddings)
+                self.chunk_ids[job["id"]].update((positions[i], id) for i, id in ids.items())
+                job["duplicate_count"] += len(documents) - len(ids)
+                job["written_count"] += len(ids)
+                job["status"] = "writing"
+                if self.is_done(job):
+                    await self.complete(job)
+
+            except Exception as ex:
+                self.fail_batch(job, len(documents), ex)
+
+
 # API Schemas
 class Document(BaseModel):
     page_content: str = Field(..., title="page_content", description="Content of the document", example="Eels and conger eels are both long, thin fish, but the difference is that eels are freshwater fish and conger eels are saltwater fish.")
@@ -31,7 +509,9 @@ class AddRequest(BaseModel):
 
 
 class AddResponse(BaseModel):
-    ids: List[str] = Field(..., title="ids", description="List of id of added documents", example=["001-aaa", "002-aaa", "003-aaa"])
+    ids: List[Optional[str]] = Field(..., title="ids", description="List of id of added documents in the order of the request. Null for duplicates", example=["001-aaa", None, "003-aaa"])
+    duplicates: List[int] = Field([], title="duplicates", description="Indices of documents skipped as duplicates", example=[1])
+    duplicate_count: int = Field(0, title="duplicate_count", description="Number of documents skipped as duplicates", example=1)
 
 
 class UploadRequest(BaseModel):
@@ -41,8 +521,28 @@ class UploadRequest(BaseModel):
     loader_params: Optional[dict] = Field(None, title="loader_params", description="Parameters for loader", example={"jq_schema": ".records[].page_content"})
 
 
-class UploadResponse(AddResponse):
-    pass
+class UploadResponse(BaseModel):
+    ids: List[str] = Field([], title="ids", description="List of id of added documents. Empty when uploaded in background", example=["001-aaa", "002-aaa", "003-aaa"])
+    job_id: Optional[str] = Field(None, title="job_id", description="Id of the ingestion job", example="5f0c6e2e-7c1b-4c4e-9a57-0d3a5d8e6f10")
+    duplicate_count: int = Field(0, title="duplicate_count", description="Number of chunks skipped as duplicates", example=0)
+
+
+class JobResponse(BaseModel):
+    id: str = Field(..., title="id", description="Id of the ingestion job", example="5f0c6e2e-7c1b-4c4e-9a57-0d3a5d8e6f10")
+    namespace: str = Field(..., title="namespace", description="Namespace documents are added to", example="default")
+    filename: str = Field(..., title="filename", description="Uploaded filename", example="fish.pdf")
+    status: str = Field(..., title="status", description="queued, loading, embedding, writing, completed or failed", example="embedding")
+    chunk_count: Optional[int] = Field(None, title="chunk_count", description="Number of new or changed chunks to embed. Null until the document is loaded", example=300)
+    embedded_count: int = Field(..., title="embedded_count", description="Number of chunks embedded", example=200)
+    written_count: int = Field(..., title="written_count", description="Number of chunks written to the vector store", example=100)
+    failed_count: int = Field(..., title="failed_count", description="Number of chunks failed to be added", example=0)
+    unchanged_count: int = Field(..., title="unchanged_count", description="Number of chunks kept as is because they are already stored for the same filename", example=250)
+    deleted_count: int = Field(..., title="deleted_count", description="Number of chunks deleted because they vanished from the document", example=10)
+    duplicate_count: int = Field(..., title="duplicate_count", description="Number of chunks skipped as duplicates", example=5)
+    ids: List[str] = Field(..., title="ids", description="List of id of added documents. Filled when the job is finished", example=["001-aaa", "002-aaa", "003-aaa"])
+    errors: List[str] = Field(..., title="errors", description="Error messages", example=[])
+    created_at: str = Field(..., title="created_at", description="Created timestamp", example="2023-08-11T12:34:56")
+    finished_at: Optional[str] = Field(None, title="finished_at", description="Finished timestamp", example="2023-08-11T12:35:56")
 
 
 class UpdateReqeust(BaseModel):
@@ -53,6 +553,7 @@ class UpdateReqeust(BaseModel):
 class GetResponse(BaseModel):
     ids: List[str] = Field(..., title="ids", description="List of id of documents", example=["001-aaa", "002-aaa"])
     documents: List[Document] = Field(..., title="documents", description="List of documents", examples=[{"page_content": "Eels and conger eels are both long, thin fish, but the difference is that eels are freshwater fish and conger eels are saltwater fish."}, {"page_content": "Red pandas are smaller than pandas, but when it comes to cuteness, there is no \"lesser\" about them."}])
+    next_offset: Optional[int] = Field(None, title="next_offset", description="Offset of the next page. Null when there are no more documents", example=100)
 
 
 class SearchResponse(BaseModel):
@@ -61,11 +562,20 @@ class SearchResponse(BaseModel):
 
 # API router
 class LangChainVSSLiteServer:
-    def __init__(self, apikey: str, persist_directory: str = "./vectorstore", chunk_size: int = 500, chunk_overlap: int = 0, embedding_function: Embeddings = None, server_args: dict = None):
+    def __init__(self, apikey: str, persist_directory: str = "./vectorstore", chunk_size: int = 500, chunk_overlap: int = 0, embedding_function: Embeddings = None, max_vector_stores: int = 100, worker_count: int = 4, loader_worker_count: int = 2, upload_directory: str = None, max_upload_size: int = 100 * 1024 * 1024, ingestion_worker_count: int = 2, ingestion_batch_size: int = 100, ingestion_batch_tokens: int = 50000, ingestion_max_in_flight_batches: int = 4, pdf_pages_per_task: int = 20, dedup: str = None, near_dup_threshold: float = 0.05, server_args: dict = None):
         self.persist_directory = persist_directory
         self.embedding_function = embedding_function or OpenAIEmbeddings(openai_api_key=apikey)
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
+        self.vector_stores = VectorStoreRegistry(self.persist_directory, self.embedding_function, max_vector_stores)
+        self.executor = ChromaExecutor(worker_count, loader_worker_count)
+        # Uploaded files are spooled to a private directory instead of the CWD
+        self.upload_directory = upload_directory or tempfile.mkdtemp(prefix="vsslite-upload-")
+        self.max_upload_size = max_upload_size
+        self.pdf_pages_per_task = pdf_pages_per_task
+        # Deduplication of chunks: None, exact or near
+        self.deduplicator = ChunkDeduplicator(dedup, near_dup_threshold) if dedup else None
+        self.ingestion_queue = IngestionQueue(self.executor, self.vector_stores, self.embedding_function, ingestion_worker_count, ingestion_batch_size, ingestion_batch_tokens, ingestion_max_in_flight_batches, deduplicator=self.deduplicator)
 
         self.app = FastAPI(**(server_args or {"title": "VSSLite API", "version": "0.6.1"}))
         self.setup_handlers()
@@ -73,21 +583,37 @@ class LangChainVSSLiteServer:
     def setup_handlers(self):
         app = self.app
 
-        def get_vector_store(namespace: str = "default") -> Chroma:
-            return Chroma(
-                persist_directory=os.path.join(self.persist_directory, namespace),
-                embedding_function=self.embedding_function
-            )
+        @app.on_event("shutdown")
+        async def close_vector_stores():
+            await self.ingestion_queue.stop()
+            self.executor.shutdown()
+            self.vector_stores.close_all()
 
         @app.get("/search/{namespace}", response_model=SearchResponse, tags=["Search"])
-        async def search_document(q: str, count: int = 4, namespace: str = "default", score_threshold: float = 0.0):
+        async def search_document(q: str, count: int = 4, namespace: str = "default", score_threshold: float = 0.0, where: str = None, mmr: bool = False, fetch_k: int = 20, lambda_mult: float = 0.5):
             try:
-                retriever = get_vector_store(namespace).as_retriever(
-                    search_type="similarity_score_threshold",
-                    search_kwargs={"k": count, "score_threshold": score_threshold}
-                )
+                # Metadata filter as JSON in Chroma where syntax, e.g. {"source": "fish.pdf"}
+                filter = json.loads(where) if where else None
+            except Exception as ex:
+                return JSONResponse({"error": f"Invalid where: {ex}"}, 400)
+
+            try:
+                with self.vector_stores.use(namespace) as store:
+                    if mmr:
+                        # Fetch fetch_k candidates and pick count of them to balance relevance and diversity
+                        retriever = store.as_retriever(
+                            search_type="mmr",
+                            search_kwargs={"k": count, "fetch_k": max(fetch_k, count), "lambda_mult": lambda_mult, "filter": filter}
+                        )
+                    else:
+                        retriever = store.as_retriever(
+                            search_type="similarity_score_threshold",
+                            search_kwargs={"k": count, "score_threshold": score_threshold, "filter": filter}
+                        )
+                    relevant_documents = await self.executor.aread(retriever.get_relevant_documents, q)
+
                 results = []
-                for d in await retriever.aget_relevant_documents(query=q):
+                for d in relevant_documents:
                     results.append(
                         Document(
                             page_content=d.page_content,
@@ -103,26 +629,43 @@ class LangChainVSSLiteServer:
                 logger.error(f"Error at search_document: {ex}\n{traceback.format_exc()}")
                 return JSONResponse({"error": "Internal server error"}, 500)
 
-        def get_documents_chroma(ids: List[str] = None, namespace: str = "default") -> tuple[List[str], List[Document]]:
+        async def get_documents_chroma(ids: List[str] = None, namespace: str = "default", limit: int = None, offset: int = None) -> tuple[List[str], List[Document]]:
             # Chroma doesn't support async
-            docs = get_vector_store(namespace).get(ids)
+            with self.vector_stores.use(namespace) as store:
+                docs = await self.executor.aread(store.get, ids, None, limit, offset)
             return docs["ids"], [Document(
                 page_content=docs["documents"][i], metadata=docs["metadatas"][i]
             ) for i in range(len(docs["documents"]))]
 
         @app.get("/document/{namespace}/all", response_model=GetResponse, tags=["Get"])
-        async def get_all_documents(namespace: str = "default"):
+        async def get_all_documents(namespace: str = "default", limit: int = None, offset: int = 0):
             try:
-                ids, documents = get_documents_chroma(namespace=namespace)
-                return GetResponse(ids=ids, documents=documents)
+                ids, documents = await get_documents_chroma(namespace=namespace, limit=limit, offset=offset or None)
+                next_offset = offset + len(ids) if limit and len(ids) == limit else None
+                return GetResponse(ids=ids, documents=documents, next_offset=next_offset)
 
             except Exception as ex:
                 logger.error(f"Error at get_document: {ex}\n{traceback.format_exc()}")
                 return JSONResponse({"error": "Internal server error"}, 500)
 
+        @app.get("/document/{namespace}/all/stream", tags=["Get"])
+        async def stream_all_documents(namespace: str = "default", page_size: int = 1000):
+            # Stream documents as NDJSON page by page not to hold all of them at once
+            async def generate():
+                offset = 0
+                while True:
+                    ids, documents = await get_documents_chroma(namespace=namespace, limit=page_size, offset=offset or None)
+                    for id, d in zip(ids, documents):
+                        yield json.dumps({"id": id, "page_content": d.page_content, "metadata": d.metadata}, ensure_ascii=False) + "\n"
+                    if len(ids) < page_size:
+                        break
+                    offset += len(ids)
+
+            return StreamingResponse(generate(), media_type="application/x-ndjson")
+
         @app.get("/document/{namespace}/{id}", response_model=GetResponse, tags=["Get"])
         async def get_document(id: str, namespace: str = "default"):
-            ids, documents = get_documents_chroma([id], namespace)
+            ids, documents = await get_documents_chroma([id], namespace)
             return GetResponse(ids=ids, documents=documents)
 
         @app.post("/document/{namespace}", response_model=AddResponse, tags=["Update"])
@@ -133,9 +676,38 @@ class LangChainVSSLiteServer:
                     metadata=d.metadata
                 ) for d in request.documents]
 
-                ids = await get_vector_store(namespace).aadd_documents(documents)
-
-                return AddResponse(ids=ids)
+                if not self.deduplicator:
+                    with self.vector_stores.use(namespace) as store:
+                        ids = await self.executor.awrite(namespace, store.add_documents, documents)
+                    return AddResponse(ids=ids)
+
+                # Embed documents not stored yet outside of the write lock not to block other writes
+                with self.vector_stores.use(namespace) as store:
+                    collection = store._collection
+                    positions = await self.executor.aread(self.deduplicator.filter_exact, collection, documents)
+                    embeddings = {}
+                    if positions:
+                        embeddings = dict(zip(positions, await asyncio.get_running_loop().run_in_executor(
+                            self.ingestion_queue.embedders, self.embedding_function.embed_documents, [documents[i].page_content for i in positions]
+                        )))
+
+                    def add_unique_documents() -> dict:
+                        # Check again under the write lock of the namespace so that concurrent adds see each other
+                        unique_positions = [positions[i] for i in self.deduplicator.filter_exact(collection, [documents[i] for i in positions])]
+                        unique_positions = [unique_positions[i] for i in self.deduplicator.filter_near(collection, [embeddings[i] for i in unique_positions])]
+                        ids = {i: str(uuid4()) for i in unique_positions}
+                        if ids:
+                            collection.upsert(
+                                list(ids.values()),
+                                [embeddings[i] for i in ids],
+                                [documents[i].metadata for i in ids],
+                                [documents[i].page_content for i in ids]
+                            )
+                        return ids
+
+                    ids = await self.executor.awrite(namespace, add_unique_documents)
+                duplicates = [i for i in range(len(documents)) if i not in ids]
+                return AddResponse(ids=[ids.get(i) for i in range(len(documents))], duplicates=duplicates, duplicate_count=len(duplicates))
 
             except Exception as ex:
                 logger.error(f"Error at add_documents: {ex}\n{traceback.format_exc()}")
@@ -144,68 +716,129 @@ class LangChainVSSLiteServer:
         @app.patch("/document/{namespace}", tags=["Update"])
         async def update_documents(request: UpdateReqeust, namespace: str = "default"):
             try:
-                get_vector_store(namespace).update_documents(
-                    request.ids,
-                    [LDocument(
-                        page_content=d.page_content,
-                        metadata=d.metadata
-                    ) for d in request.documents]
-                )
+                with self.vector_stores.use(namespace) as store:
+                    await self.executor.awrite(
+                        namespace,
+                        store.update_documents,
+                        request.ids,
+                        [LDocument(
+                            page_content=d.page_content,
+                            metadata=d.metadata
+                        ) for d in request.documents]
+                    )
                 return JSONResponse({})
 
             except Exception as ex:
                 logger.error(f"Error at update_documents: {ex}\n{traceback.format_exc()}")
                 return JSONResponse({"error": "Internal server error"}, 500)
 
+        def make_upload_path(document_type: str) -> str:
+            fd, path = tempfile.mkstemp(suffix=document_type.replace("/", "_"), dir=self.upload_directory)
+            os.close(fd)
+            return path
+
+        async def submit_upload(path: str, filename: str, document_type: str, loader_params: dict, namespace: str, background: bool):
+            try:
+                # Make a loader here to validate document_type and loader_params. Loading runs in a loader process
+                if make_loader(path, document_type, loader_params) is None:
+                    os.remove(path)
+                    return JSONResponse({"error": "Invalid document_type. We accept pdf or txt for now."}, 400)
+
+            except Exception as ex:
+                logger.error(f"Error at upload_document: {ex}\n{traceback.format_exc()}")
+                os.remove(path)
+                return JSONResponse({"error": "Invalid loader_params"}, 400)
+
+            text_splitter = RecursiveCharacterTextSplitter(
+                chunk_size=self.chunk_size,
+                chunk_overlap=self.chunk_overlap
+            )
+
+            async def load() -> List[LDocument]:
+                try:
+                    if document_type.lower() == ".pdf" and not loader_params and self.pdf_pages_per_task:
+                        # Extract text of page ranges across loader processes and join them in order
+                        page_count = await self.executor.aload(count_pdf_pages, path)
+                        texts = await asyncio.gather(*[
+                            self.executor.aload(extract_pdf_text, path, list(range(i, min(i + self.pdf_pages_per_task, page_count))))
+                            for i in range(0, page_count, self.pdf_pages_per_task)
+                        ])
+                        documents = [LDocument(page_content="".join(texts), metadata={"source": filename})]
+                    else:
+                        documents = await self.executor.aload(load_documents, path, document_type, loader_params)
+
+                    splited_documents = await self.executor.aread(text_splitter.split_documents, documents)
+                    for d in splited_documents:
+                        # Store the uploaded filename instead of the spooled path
+                        d.metadata["source"] = filename
+                    return splited_documents
+                finally:
+                    os.remove(path)
+
+            job = self.ingestion_queue.submit(namespace, filename, load)
+            if background:
+                return UploadResponse(job_id=job["id"])
+
+            job = await self.ingestion_queue.wait(job["id"])
+            if job["errors"]:
+                return JSONResponse({"error": "Internal server error", "job_id": job["id"]}, 500)
+            return UploadResponse(ids=job["ids"], job_id=job["id"], duplicate_count=job["duplicate_count"])
+
         @app.post("/document/{namespace}/upload", response_model=UploadResponse, tags=["Update"])
-        async def upload_document(request: UploadRequest, namespace: str = "default"):
+        async def upload_document(request: UploadRequest, namespace: str = "default", background: bool = False):
+            path = make_upload_path(request.document_type)
             try:
-                safe_filename = request.filename.replace("/", "_").replace("..", "_")
                 binary_data = base64.b64decode(request.b64content)
-                async with aiofiles.open(safe_filename, "wb") as file:
+                async with aiofiles.open(path, "wb") as file:
                     await file.write(binary_data)
 
             except Exception as ex:
                 logger.error(f"Error at upload_document: {ex}\n{traceback.format_exc()}")
+                os.remove(path)
                 return JSONResponse({"error": "Invalid content or filename"}, 400)
 
+            return await submit_upload(path, request.filename, request.document_type, request.loader_params, namespace, background)
+
+        @app.post("/document/{namespace}/upload/stream", response_model=UploadResponse, tags=["Update"])
+        async def upload_document_stream(request: Request, filename: str, document_type: str = None, loader_params: str = None, namespace: str = "default", background: bool = False):
+            # Receive the raw file as the request body and spool it to disk chunk by chunk
+            document_type = document_type or os.path.splitext(filename)[1]
+            path = make_upload_path(document_type)
             try:
-                loader_params = request.loader_params or {}
-
-                if request.document_type.lower() == ".pdf":
-                    loader = PDFMinerLoader(safe_filename, **loader_params)
-                elif request.document_type.lower() == ".txt":
-                    loader = TextLoader(safe_filename, **loader_params)
-                elif request.document_type.lower() == ".csv":
-                    loader = CSVLoader(safe_filename, **loader_params)
-                elif request.document_type.lower() == ".json":
-                    loader = JSONLoader(safe_filename, **loader_params)
-                else:
-                    return JSONResponse({"error": "Invalid document_type. We accept pdf or txt for now."}, 400)
+                loader_params = json.loads(loader_params) if loader_params else None
+                size = 0
+                async with aiofiles.open(path, "wb") as file:
+                    async for chunk in request.stream():
+                        size += len(chunk)
+                        if size > self.max_upload_size:
+                            os.remove(path)
+                            return JSONResponse({"error": f"File size exceeds the limit ({self.max_upload_size} bytes)"}, 413)
+                        await file.write(chunk)
 
-                documents = loader.load()
-                os.remove(safe_filename)
+            except Exception as ex:
+                logger.error(f"Error at upload_document_stream: {ex}\n{traceback.format_exc()}")
+                os.remove(path)
+                return JSONResponse({"error": "Invalid content or loader_params"}, 400)
 
-                text_splitter = RecursiveCharacterTextSplitter(
-                    chunk_size=self.chunk_size,
-                    chunk_overlap=self.chunk_overlap
-                )
-                splited_documents = text_splitter.split_documents(documents)
-                ids = await get_vector_store(namespace).aadd_documents(splited_documents)
-                return AddResponse(ids=ids)
+            return await submit_upload(path, filename, document_type, loader_params, namespace, background)
 
-            except Exception as ex:
-                logger.error(f"Error at upload_document: {ex}\n{traceback.format_exc()}")
-                return JSONResponse({"error": "Internal server error"}, 500)
+        @app.get("/jobs/{id}", response_model=JobResponse, tags=["Update"])
+        async def get_job(id: str):
+            # Jobs are kept in memory of the worker process that accepted the upload.
+            # Poll them only when requests are routed to the same process, e.g. a single worker
+            job = self.ingestion_queue.get(id)
+            if not job:
+                return JSONResponse({"error": f"Job {id} not found"}, 404)
+            return JobResponse(**job)
 
         @app.delete("/document/{namespace}/all", tags=["Delete"])
         async def delete_all_documents(namespace: str = "default"):
             try:
-                ids = get_documents_chroma(namespace=namespace)[0]
-                if ids:
-                    # Chroma doesn't support async
-                    get_vector_store(namespace).delete(ids)
-                    return JSONResponse({})
+                # Drop the collection instead of deleting all ids. It is recreated on the next access
+                with self.vector_stores.use(namespace) as store:
+                    await self.executor.awrite(namespace, store.delete_collection)
+                self.vector_stores.discard(namespace)
+                return JSONResponse({})
 
             except Exception as ex:
                 logger.error(f"Error at delete_all_documents: {ex}\n{traceback.format_exc()}")
@@ -215,7 +848,8 @@ class LangChainVSSLiteServer:
         async def delete_document(id: str, namespace: str = "default"):
             try:
                 # Chroma doesn't support async
-                get_vector_store(namespace).delete([id])
+                with self.vector_stores.use(namespace) as store:
+                    await self.executor.awrite(namespace, store.delete, [id])
                 return JSONResponse({})
 
             except Exception as ex:
@@ -0,0 +1,43 @@
+import asyncio
+import threading
+from typing import Any, Coroutine
+
+
+class LoopRunner:
+    # Runs an event loop on a background thread so that sync APIs can submit
+    # coroutines from any thread and share loop-bound resources like sessions.
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run_forever, name="vsslite-loop", daemon=True)
+        self.thread.start()
+
+    def run_forever(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run(self, coro: Coroutine, timeout: float=None) -> Any:
+        if threading.current_thread() is self.thread:
+            coro.close()
+            raise RuntimeError("Sync API can't be called on the event loop of VSSLite. Use async API instead.")
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_loop_runner() -> LoopRunner:
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = LoopRunner()
+        return _runner
+
+
+def run_sync(coro: Coroutine) -> Any:
+    return get_loop_runner().run(coro)
@@ -0,0 +1,152 @@
+import threading
+from typing import List, Tuple
+
+import numpy as np
+
+QUANTIZATION_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+
+def quantize_vectors(vectors: List[List[float]], dtype: str = "float32") -> Tuple[np.ndarray, np.ndarray]:
+    # Returns codes and per-vector scales. Only int8 uses scales; the others are 1.0
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    if dtype == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales = np.where(scales > 0, scales, 1.0).astype(np.float32)
+        codes = np.clip(np.rint(vectors / scales[:, np.newaxis]), -127, 127).astype(np.int8)
+        return codes, scales
+    else:
+        return vectors.astype(QUANTIZATION_DTYPES[dtype]), np.ones(len(vectors), dtype=np.float32)
+
+
+def dequantize_vectors(codes: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    return codes.astype(np.float32) * scales[:, np.newaxis]
+
+
+class VectorMatrix:
+    # In-memory matrix of a namespace for brute-force search.
+    # Rows are appended into spare capacity and deleted rows are only marked
+    # so that readers can keep using a snapshot while the writer updates it.
+    # With float16 or int8 dtype the distances are approximate; rerank the results if needed.
+    def __init__(self, dimension: int, capacity: int = 1024, dtype: str = "float32", chunk_size: int = 4096):
+        self.dimension = dimension
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.size = 0
+        self.deleted_count = 0
+        self.rows = {}
+        self.allocate(max(capacity, 1))
+
+    def allocate(self, capacity: int):
+        ids = np.zeros(capacity, dtype=np.int64)
+        vectors = np.zeros((capacity, self.dimension), dtype=QUANTIZATION_DTYPES[self.dtype])
+        scales = np.ones(capacity, dtype=np.float32)
+        norms = np.zeros(capacity, dtype=np.float32)
+        deleted = np.zeros(capacity, dtype=bool)
+        if self.size:
+            ids[:self.size] = self.ids[:self.size]
+            vectors[:self.size] = self.vectors[:self.size]
+            scales[:self.size] = self.scales[:self.size]
+            norms[:self.size] = self.norms[:self.size]
+            deleted[:self.size] = self.deleted[:self.size]
+        self.ids, self.vectors, self.scales, self.norms, self.deleted = ids, vectors, scales, norms, deleted
+
+    def __len__(self) -> int:
+        return self.size - self.deleted_count
+
+    @property
+    def nbytes(self) -> int:
+        return self.ids.nbytes + self.vectors.nbytes + self.scales.nbytes + self.norms.nbytes + self.deleted.nbytes
+
+    def add(self, ids: List[int], vectors: List[List[float]]):
+        codes, scales = quantize_vectors(np.asarray(vectors, dtype=np.float32).reshape(-1, self.dimension), self.dtype)
+        self.add_codes(ids, codes, scales)
+
+    def add_codes(self, ids: List[int], codes: np.ndarray, scales: np.ndarray):
+        with self.lock:
+            self.add_rows(ids, codes, scales)
+
+    def add_rows(self, ids: List[int], codes: np.ndarray, scales: np.ndarray):
+        self.remove_rows(ids)
+
+        if self.size + len(ids) > len(self.ids):
+            # Grow geometrically to amortize copying
+            self.allocate(max(int(len(self.ids) * 1.5), self.size + len(ids)))
+
+        codes = np.asarray(codes).reshape(-1, self.dimension)
+        vectors = dequantize_vectors(codes, scales)
+        start = self.size
+        end = start + len(ids)
+        self.ids[start:end] = ids
+        self.vectors[start:end] = codes
+        self.scales[start:end] = scales
+        self.norms[start:end] = np.einsum("ij,ij->i", vectors, vectors)
+        self.deleted[start:end] = False
+        for i, id in enumerate(ids):
+            self.rows[id] = start + i
+        # Publish new rows to readers after they are written
+        self.size = end
+
+    def remove(self, ids: List[int]):
+        with self.lock:
+            self.remove_rows(ids)
+
+    def remove_rows(self, ids: List[int]):
+        for id in ids:
+            row = self.rows.pop(id, None)
+            if row is not None:
+                self.deleted[row] = True
+                self.deleted_count += 1
+
+        if self.deleted_count > 1024 and self.deleted_count > self.size // 4:
+            self.compact()
+
+    def compact(self):
+        alive = ~self.deleted[:self.size]
+        ids = self.ids[:self.size][alive]
+        codes = self.vectors[:self.size][alive]
+        scales = self.scales[:self.size][alive]
+        self.size = 0
+        self.deleted_count = 0
+        self.rows = {}
+        self.allocate(max(len(ids), 1))
+        self.add_rows(ids.tolist(), codes, scales)
+
+    def dot(self, vectors: np.ndarray, scales: np.ndarray, queries: np.ndarray) -> np.ndarray:
+        if self.dtype == "float32":
+            return queries @ vectors.T
+
+        # Dequantize by chunk to use BLAS without materializing the whole matrix in float32
+        ret = np.empty((len(queries), len(vectors)), dtype=np.float32)
+        for start in range(0, len(vectors), self.chunk_size):
+            end = start + self.chunk_size
+            ret[:, start:end] = (queries @ vectors[start:end].astype(np.float32).T) * scales[start:end]
+        return ret
+
+    def search(self, query_vectors: List[List[float]], count: int) -> List[List[Tuple[int, float]]]:
+        # Take a snapshot; the writer never modifies rows below size except marking deletions
+        with self.lock:
+            size = self.size
+            ids, vectors, scales, norms, deleted = self.ids[:size], self.vectors[:size], self.scales[:size], self.norms[:size], self.deleted[:size]
+
+        queries = np.asarray(query_vectors, dtype=np.float32).reshape(-1, self.dimension)
+        if size == 0:
+            return [[] for _ in range(len(queries))]
+
+        # Squared L2 distance, the same metric as vss0 (faiss IndexFlatL2)
+        distances = norms[np.newaxis, :] - 2 * self.dot(vectors, scales, queries) + np.einsum("ij,ij->i", queries, queries)[:, np.newaxis]
+        distances[:, deleted] = np.inf
+        np.maximum(distances, 0, out=distances)
+
+        k = min(count, size)
+        if k < size:
+            candidates = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        else:
+            candidates = np.tile(np.arange(size), (len(queries), 1))
+
+        ret = []
+        for i in range(len(queries)):
+            cand = candidates[i]
+            cand = cand[np.argsort(distances[i, cand], kind="stable")]
+            ret.append([(int(ids[j]), float(distances[i, j])) for j in cand if not np.isinf(distances[i, j])])
+        return ret
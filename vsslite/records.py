@@ -0,0 +1,120 @@
+import csv
+import json
+import os
+import re
+from typing import AsyncIterator
+
+import aiofiles
+
+
+async def adetect_format(path: str) -> str:
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".jsonl", ".ndjson"):
+        return "jsonl"
+    elif ext == ".json":
+        return "json"
+    elif ext == ".csv":
+        return "csv"
+
+    # Sniff the first line for other extensions
+    async with aiofiles.open(path, mode="r", newline="") as file:
+        async for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("["):
+                return "json"
+            if line.startswith("{"):
+                try:
+                    json.loads(line)
+                    return "jsonl"
+                except Exception:
+                    return "json"
+            return "csv"
+
+    return "csv"
+
+
+async def aiter_json_records(path: str, chunk_size: int = 1024 * 1024) -> AsyncIterator[dict]:
+    # Decode elements of the records array, or the top-level array, one by one
+    # while reading the file chunk by chunk.
+    decoder = json.JSONDecoder()
+    async with aiofiles.open(path, mode="r") as file:
+        buffer = ""
+        eof = False
+        pos = None
+        while pos is None:
+            chunk = await file.read(chunk_size)
+            eof = not chunk
+            buffer += chunk
+            m = re.match(r"\s*\[", buffer) or re.search(r"\"records\"\s*:\s*\[", buffer)
+            if m:
+                pos = m.end()
+            elif eof:
+                raise ValueError("Records array not found")
+
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+
+            try:
+                record, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = await file.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+
+            yield record
+            pos = end
+            if pos > chunk_size:
+                buffer = buffer[pos:]
+                pos = 0
+
+
+async def aiter_jsonl_records(path: str) -> AsyncIterator[dict]:
+    async with aiofiles.open(path, mode="r") as file:
+        async for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+async def aiter_csv_records(path: str) -> AsyncIterator[dict]:
+    async with aiofiles.open(path, mode="r", newline="") as file:
+        header = None
+        lines = []
+        async for line in file:
+            lines.append(line)
+            # Quoted fields may contain line breaks. A row is complete when quotes are balanced
+            if sum(l.count('"') for l in lines) % 2:
+                continue
+
+            row = next(csv.reader(lines), [])
+            lines = []
+            if not row:
+                continue
+            if header is None:
+                header = row
+                continue
+            yield {k: row[i] if i < len(row) else None for i, k in enumerate(header)}
+
+
+async def aiter_records(path: str, format: str = None) -> AsyncIterator[dict]:
+    # Read records from JSON ({"records": [...]} or [...]), JSON Lines or CSV without loading the whole file
+    format = format or await adetect_format(path)
+    if format == "json":
+        iterator = aiter_json_records(path)
+    elif format == "jsonl":
+        iterator = aiter_jsonl_records(path)
+    elif format == "csv":
+        iterator = aiter_csv_records(path)
+    else:
+        raise ValueError(f"Unsupported format: {format}")
+
+    async for r in iterator:
+        yield r
@@ -0,0 +1,93 @@
+import asyncio
+from collections import deque
+import itertools
+import random
+from typing import Any, Awaitable, Callable, List
+
+import aiohttp
+
+
+class ReplicaRequester:
+    # Sends idempotent requests to replicas with jittered retries and optional hedging.
+    # A hedged request goes to another replica when the first one takes longer than
+    # the recent latency percentile. All attempts share the deadline of the call.
+    def __init__(self, base_urls: List[str], retry_count: int=2, backoff_base: float=0.1, backoff_max: float=2.0, hedge: bool=False, hedge_percentile: float=0.95, hedge_min_samples: int=20, latency_window: int=200):
+        self.base_urls = base_urls
+        self.retry_count = retry_count
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.latencies = deque(maxlen=latency_window)
+        self.url_cycle = itertools.cycle(base_urls)
+
+    @staticmethod
+    def is_retryable(ex: Exception) -> bool:
+        if isinstance(ex, aiohttp.ClientResponseError):
+            return ex.status >= 500 or ex.status == 429
+        return isinstance(ex, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+    def get_hedge_delay(self) -> float:
+        if not self.hedge or len(self.base_urls) < 2 or len(self.latencies) < self.hedge_min_samples:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.hedge_percentile))]
+
+    async def asend(self, send: Callable[[str, float], Awaitable[Any]], base_url: str, timeout: float) -> Any:
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        ret = await asyncio.wait_for(send(base_url, timeout), timeout)
+        self.latencies.append(loop.time() - start)
+        return ret
+
+    async def ahedged(self, send: Callable[[str, float], Awaitable[Any]], timeout: float) -> Any:
+        primary_url = next(self.url_cycle)
+        delay = self.get_hedge_delay()
+        if delay is None or (timeout is not None and delay >= timeout):
+            return await self.asend(send, primary_url, timeout)
+
+        tasks = {asyncio.create_task(self.asend(send, primary_url, timeout))}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done:
+                return done.pop().result()
+
+            # Primary is slower than usual. Send the same request to the next replica
+            hedge_url = next(self.url_cycle)
+            if hedge_url == primary_url:
+                hedge_url = next(self.url_cycle)
+            tasks.add(asyncio.create_task(self.asend(send, hedge_url, None if timeout is None else timeout - delay)))
+
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    if t.exception() is None:
+                        return t.result()
+                    error = t.exception()
+            raise error
+
+        finally:
+            for t in tasks:
+                t.cancel()
+
+    async def arequest(self, send: Callable[[str, float], Awaitable[Any]], timeout: float) -> Any:
+        # `send` makes a request to the base url within the timeout in seconds. No deadline if timeout is None
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        for attempt in range(self.retry_count + 1):
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                raise asyncio.TimeoutError()
+
+            try:
+                return await self.ahedged(send, remaining)
+
+            except Exception as ex:
+                if attempt >= self.retry_count or not self.is_retryable(ex):
+                    raise
+                backoff = min(self.backoff_max, self.backoff_base * 2 ** attempt) * random.uniform(0.5, 1.5)
+                if deadline is not None and loop.time() + backoff >= deadline:
+                    raise
+                await asyncio.sleep(backoff)
@@ -4,6 +4,7 @@ from typing import List, Optional
 from fastapi import FastAPI
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
+from .embeddings import EmbeddingProvider
 from .vsslite import VSSLite
 
 logger = getLogger(__name__)
@@ -19,6 +20,14 @@ class AddResponse(BaseModel):
     id: int = Field(..., title="id", description="Record id", example=3)
 
 
+class AddManyRequest(BaseModel):
+    records: List[AddRequest] = Field(..., title="records", description="Records to add at once. All of them are added or none")
+
+
+class AddManyResponse(BaseModel):
+    ids: List[int] = Field(..., title="ids", description="Record ids in the same order as records", example=[3, 4])
+
+
 class UpdateReqeust(AddRequest):
     pass
 
@@ -47,16 +56,52 @@ class SearchResponse(BaseModel):
     results: List[SearchResult] = Field(..., title="results", description="Search results")
 
 
+class SearchBatchRequest(BaseModel):
+    queries: List[str] = Field(..., title="queries", description="Queries to search at once", example=["fish", "eel price"])
+    count: int = Field(1, title="count", description="Number of results for each query", example=3)
+
+
+class SearchBatchResponse(BaseModel):
+    results: List[List[SearchResult]] = Field(..., title="results", description="Search results for each query in the same order as queries")
+
+
+class IndexRequest(BaseModel):
+    index_factory: Optional[str] = Field(None, title="index_factory", description="Faiss index factory. Current one is used if omitted. IVF indexes probe only one list and their recall is poor", example="PQ32")
+    sample_size: Optional[int] = Field(None, title="sample_size", description="Number of vectors sampled to train the index. All vectors are used if omitted", example=100000)
+
+
+class IndexResponse(BaseModel):
+    index_factory: Optional[str] = Field(None, title="index_factory", description="Faiss index factory", example="PQ32")
+    trained_count: int = Field(..., title="trained_count", description="Number of vectors used for training", example=100000)
+    indexed_count: int = Field(..., title="indexed_count", description="Number of vectors added to the index", example=1000000)
+
+
 class ApiResponse(BaseModel):
     message: str = Field(..., title="message", description="Message from API", example="Embeddings created successfully")
 
 
 # API router
 class VSSLiteServer:
-    def __init__(self, openai_apikey: str, connection_str: str="vss.db", server_args: dict=None):
+    def __init__(self, openai_apikey: str, connection_str: str="vss.db", pool_size: int=5, pragmas: dict=None, reader_count: int=4, embedding_batch_size: int=100, embedding_batch_tokens: int=50000, embedding_provider: EmbeddingProvider=None, embedding_cache_size: int=10000, persist_embedding_cache: bool=True, namespace_overfetch: float=2.0, exact_search_threshold: int=50000, quantization: str=None, rerank_factor: int=4, index_factory: str=None, persistent_embedding_cache_size: int=100000, max_matrix_bytes: int=1024 ** 3, persist_query_embeddings: bool=False, server_args: dict=None):
         self.vssengine = VSSLite(
             openai_apikey=openai_apikey,
-            connection_str=connection_str
+            connection_str=connection_str,
+            pool_size=pool_size,
+            pragmas=pragmas,
+            reader_count=reader_count,
+            embedding_batch_size=embedding_batch_size,
+            embedding_batch_tokens=embedding_batch_tokens,
+            embedding_provider=embedding_provider,
+            embedding_cache_size=embedding_cache_size,
+            persist_embedding_cache=persist_embedding_cache,
+            namespace_overfetch=namespace_overfetch,
+            exact_search_threshold=exact_search_threshold,
+            quantization=quantization,
+            rerank_factor=rerank_factor,
+            index_factory=index_factory,
+            persistent_embedding_cache_size=persistent_embedding_cache_size,
+            max_matrix_bytes=max_matrix_bytes,
+            persist_query_embeddings=persist_query_embeddings
         )
         self.vssengine.create_tables()
         self.app = FastAPI(**(server_args or {"title": "VSSLite Classic API", "version": "0.6.1"}))
@@ -86,6 +131,27 @@ class VSSLiteServer:
                 logger.error(f"Error at vssengine.search_knowledge: {ex}\n{traceback.format_exc()}")
                 return JSONResponse({"error": "Internal server error"}, 500)
 
+        @app.post("/knowledge/{namespace}/search/batch", response_model=SearchBatchResponse, tags=["Vector Similarity Search"])
+        async def search_knowledge_batch(namespace: str, request: SearchBatchRequest):
+            try:
+                results = []
+                for rs in await self.vssengine.asearch_many(request.queries, request.count, namespace):
+                    results.append([
+                        SearchResult(
+                            id=r["id"],
+                            updated_at=r["updated_at"],
+                            namespace=r["namespace"],
+                            body=r["body"],
+                            data=r["data"],
+                            distance=r["distance"]
+                        ) for r in rs
+                    ])
+                return SearchBatchResponse(results=results)
+
+            except Exception as ex:
+                logger.error(f"Error at vssengine.search_knowledge_batch: {ex}\n{traceback.format_exc()}")
+                return JSONResponse({"error": "Internal server error"}, 500)
+
         @app.post("/knowledge/{namespace}", response_model=AddResponse, tags=["Data management"])
         async def add_knowledge(namespace: str, request: AddRequest):
             try:
@@ -96,6 +162,16 @@ class VSSLiteServer:
                 logger.error(f"Error at vssengine.add: {ex}\n{traceback.format_exc()}")
                 return JSONResponse({"error": "Internal server error"}, 500)
 
+        @app.post("/knowledge/{namespace}/batch", response_model=AddManyResponse, tags=["Data management"])
+        async def add_knowledge_batch(namespace: str, request: AddManyRequest):
+            try:
+                ids = await self.vssengine.aadd_many([r.body for r in request.records], [r.data for r in request.records], namespace)
+                return AddManyResponse(ids=ids)
+
+            except Exception as ex:
+                logger.error(f"Error at vssengine.add_many: {ex}\n{traceback.format_exc()}")
+                return JSONResponse({"error": "Internal server error"}, 500)
+
         @app.patch("/knowledge/{id}", response_model=UpdateResponse, tags=["Data management"])
         async def update_knowledge(id: int, request: UpdateReqeust):
             try:
@@ -149,3 +225,21 @@ class VSSLiteServer:
             except Exception as ex:
                 logger.error(f"Error at vssengine.get_knowledge: {ex}\n{traceback.format_exc()}")
                 return JSONResponse({"error": "Internal server error"}, 500)
+
+        @app.post("/index/rebuild", response_model=IndexResponse, tags=["Index management"])
+        async def rebuild_index(request: IndexRequest):
+            try:
+                return IndexResponse(**(await self.vssengine.arebuild_index(request.index_factory, request.sample_size)))
+
+            except Exception as ex:
+                logger.error(f"Error at vssengine.rebuild_index: {ex}\n{traceback.format_exc()}")
+                return JSONResponse({"error": "Internal server error"}, 500)
+
+        @app.post("/index/train", response_model=IndexResponse, tags=["Index management"])
+        async def train_index(request: IndexRequest):
+            try:
+                return IndexResponse(**(await self.vssengine.atrain_index(request.sample_size)))
+
+            except Exception as ex:
+                logger.error(f"Error at vssengine.train_index: {ex}\n{traceback.format_exc()}")
+                return JSONResponse({"error": "Internal server error"}, 500)
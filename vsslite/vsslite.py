@@ -1,45 +1,313 @@
 import asyncio
-import aiofiles
-import csv
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 import json
+import re
 from logging import getLogger, NullHandler
 import traceback
-from typing import List
+import queue
+import threading
+from typing import Any, Callable, List
 import sqlite3
 import sqlite_vss
 import numpy as np
-from openai import Embedding
+from .embeddings import EmbeddingCache, EmbeddingProvider, OpenAIEmbeddingProvider
+from .loop import run_sync
+from .matrix import VectorMatrix
+from .records import aiter_records
 
 logger = getLogger(__name__)
 logger.addHandler(NullHandler())
 
 
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 268435456,
+    "cache_size": -16000
+}
+
+
+class PooledConnection(sqlite3.Connection):
+    # Version of the vss0 index loaded in memory of this connection
+    index_version = None
+
+
+class ConnectionPool:
+    def __init__(self, connection_str: str, pool_size: int=5, pragmas: dict=None, cached_statements: int=128):
+        self.connection_str = connection_str
+        # Each connection to :memory: is a separate database
+        self.pool_size = 1 if connection_str == ":memory:" else max(pool_size, 1)
+        self.pragmas = DEFAULT_PRAGMAS if pragmas is None else pragmas
+        self.cached_statements = cached_statements
+        self.idle_connections = queue.LifoQueue()
+        self.created_count = 0
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def create_connection(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.connection_str,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+            factory=PooledConnection
+        )
+        try:
+            conn.enable_load_extension(True)
+            sqlite_vss.load(conn)
+            conn.enable_load_extension(False)
+            for k, v in self.pragmas.items():
+                conn.execute(f"pragma {k} = {v}")
+            return conn
+
+        except Exception:
+            conn.close()
+            raise
+
+    def acquire(self, timeout: float=None) -> sqlite3.Connection:
+        if self.closed:
+            raise RuntimeError("Connection pool is already closed")
+
+        try:
+            return self.idle_connections.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            can_create = self.created_count < self.pool_size
+            if can_create:
+                self.created_count += 1
+
+        if can_create:
+            try:
+                return self.create_connection()
+            except Exception:
+                with self.lock:
+                    self.created_count -= 1
+                raise
+
+        return self.idle_connections.get(timeout=timeout)
+
+    def reconnect(self, conn: sqlite3.Connection) -> sqlite3.Connection:
+        # Replace the connection with a new one without changing the number of connections
+        conn.close()
+        try:
+            return self.create_connection()
+        except Exception:
+            with self.lock:
+                self.created_count -= 1
+            raise
+
+    def release(self, conn: sqlite3.Connection):
+        if self.closed:
+            conn.close()
+            return
+
+        if conn.in_transaction:
+            conn.rollback()
+        self.idle_connections.put(conn)
+
+    def close(self):
+        self.closed = True
+        while True:
+            try:
+                self.idle_connections.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class SQLiteExecutor:
+    # SQLite allows only one writer at a time so writes are serialized on
+    # a dedicated thread while reads run concurrently on the reader pool.
+    def __init__(self, reader_count: int=4):
+        self.reader_count = reader_count
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vsslite-writer")
+        self.readers = ThreadPoolExecutor(max_workers=reader_count, thread_name_prefix="vsslite-reader")
+        self.lock = threading.Lock()
+        self.stats = {
+            "reader": {"pending": 0, "max_pending": 0, "completed": 0},
+            "writer": {"pending": 0, "max_pending": 0, "completed": 0}
+        }
+
+    async def arun(self, kind: str, executor: ThreadPoolExecutor, func: Callable, *args) -> Any:
+        stats = self.stats[kind]
+        with self.lock:
+            stats["pending"] += 1
+            stats["max_pending"] = max(stats["max_pending"], stats["pending"])
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+        finally:
+            with self.lock:
+                stats["pending"] -= 1
+                stats["completed"] += 1
+
+    async def aread(self, func: Callable, *args) -> Any:
+        return await self.arun("reader", self.readers, func, *args)
+
+    async def awrite(self, func: Callable, *args) -> Any:
+        return await self.arun("writer", self.writer, func, *args)
+
+    def write_nowait(self, func: Callable, *args) -> Future:
+        stats = self.stats["writer"]
+        with self.lock:
+            stats["pending"] += 1
+            stats["max_pending"] = max(stats["max_pending"], stats["pending"])
+
+        def done(_):
+            with self.lock:
+                stats["pending"] -= 1
+                stats["completed"] += 1
+
+        future = self.writer.submit(func, *args)
+        future.add_done_callback(done)
+        return future
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "reader": dict(self.stats["reader"], workers=self.reader_count),
+                "writer": dict(self.stats["writer"], workers=1)
+            }
+
+    def shutdown(self):
+        self.writer.shutdown(wait=True)
+        self.readers.shutdown(wait=True)
+
+
 class VSSLite:
-    def __init__(self, openai_apikey: str, connection_str: str="vss.db"):
+    # Number of vectors read at once to rebuild the index or to load a matrix
+    vector_page_size = 10000
+
+    def __init__(self, openai_apikey: str, connection_str: str="vss.db", pool_size: int=5, pragmas: dict=None, reader_count: int=4, embedding_batch_size: int=100, embedding_batch_tokens: int=50000, embedding_provider: EmbeddingProvider=None, embedding_cache_size: int=10000, persist_embedding_cache: bool=True, namespace_overfetch: float=2.0, exact_search_threshold: int=50000, quantization: str=None, rerank_factor: int=4, index_factory: str=None, persistent_embedding_cache_size: int=100000, max_matrix_bytes: int=1024 ** 3, persist_query_embeddings: bool=False):
         self.openai_apikey = openai_apikey
         self.connection_str = connection_str
+        self.embedding_provider = embedding_provider or OpenAIEmbeddingProvider(openai_apikey)
+        self.dimension = self.embedding_provider.dimension
+        self.embedding_batch_size = embedding_batch_size
+        self.embedding_batch_tokens = embedding_batch_tokens
+        self.embedding_cache = EmbeddingCache(embedding_cache_size)
+        self.persist_embedding_cache = persist_embedding_cache
+        # About 6KB per embedding of 1536 dimensions, so 600MB at most by default
+        self.persistent_embedding_cache_size = persistent_embedding_cache_size
+        # Queries are rarely repeated across restarts. Persist only embeddings of bodies by default
+        self.persist_query_embeddings = persist_query_embeddings
+        self.persistent_embedding_cache_count = 0
+        self.namespace_overfetch = namespace_overfetch
+        self.exact_search_threshold = exact_search_threshold
+        if quantization not in (None, "float16", "int8"):
+            raise ValueError(f"Unsupported quantization: {quantization}")
+        self.quantization = quantization
+        self.rerank_factor = rerank_factor
+        # Faiss index factory of vss0, e.g. "PQ32". sqlite-vss 0.1.2 doesn't expose nprobe and IVF indexes
+        # probe only one list, so their recall is poor. Reranking can't bring back neighbors in other lists
+        self.index_factory = index_factory
+        self.index_trained = True
+        # LRU of matrices for exact search. Matrices of other namespaces are released over max_matrix_bytes
+        self.max_matrix_bytes = max_matrix_bytes
+        self.matrices = OrderedDict()
+        self.loading_matrices = {}
+        self.matrices_lock = threading.Lock()
+        # Keep a connection for the writer in addition to the readers
+        self.pool = ConnectionPool(connection_str, max(pool_size, reader_count + 1), pragmas)
+        self.index_versioned = False
+        self.executor = SQLiteExecutor(reader_count)
         self.create_tables()
 
     def sync(self, future):
-        return asyncio.get_event_loop().run_until_complete(future)
+        # Run on the shared background loop so that this works from any thread or inside running loops
+        return run_sync(future)
 
-    def get_connection(self) -> sqlite3.Connection:
-        conn = sqlite3.connect(
-            self.connection_str,
-            isolation_level=None
+    def get_connection(self, read: bool=False) -> sqlite3.Connection:
+        conn = self.pool.acquire()
+        if not self.index_versioned:
+            return conn
+
+        while True:
+            try:
+                # Reads run in a transaction so that records are consistent with the index of the connection
+                if read:
+                    conn.execute("begin")
+                version = conn.execute("select version from index_version").fetchone()[0]
+            except Exception:
+                self.release_connection(conn)
+                raise
+            if conn.index_version is None:
+                conn.index_version = version
+            if conn.index_version == version:
+                return conn
+            # vss0 keeps the index in memory of each connection and doesn't see vectors
+            # written by other connections. Reconnect to load the latest one
+            conn = self.pool.reconnect(conn)
+
+    def update_index_version(self, conn: sqlite3.Connection):
+        # Call in the transaction that changes vss0 to let other connections reload the index
+        conn.execute("update index_version set version = version + 1")
+        conn.index_version = conn.execute("select version from index_version").fetchone()[0]
+
+    def release_connection(self, conn: sqlite3.Connection):
+        self.pool.release(conn)
+
+    def update_count(self, conn: sqlite3.Connection, namespace: str, delta: int):
+        # Call in the transaction that writes knowledges
+        conn.execute(
+            "insert into record_counts (namespace, count) values (?, ?) on conflict (namespace) do update set count = count + excluded.count",
+            (namespace, delta)
         )
-        conn.enable_load_extension(True)
-        sqlite_vss.load(conn)
-        return conn
+        conn.execute("delete from record_counts where namespace = ? and count <= 0", (namespace, ))
+
+    def select_counts(self, conn: sqlite3.Connection, namespace: str) -> tuple:
+        # Returns the record count of the namespace and the total
+        return conn.execute(
+            "select ifnull((select count from record_counts where namespace = ?), 0), ifnull((select sum(count) from record_counts), 0)",
+            (namespace, )
+        ).fetchone()
+
+    def get_stats(self) -> dict:
+        with self.matrices_lock:
+            matrices = {"count": len(self.matrices), "bytes": sum(m.nbytes for m in self.matrices.values()), "max_bytes": self.max_matrix_bytes}
+        return dict(self.executor.get_stats(), embedding_cache=self.embedding_cache.get_stats(), matrices=matrices)
+
+    def close(self):
+        self.executor.shutdown()
+        self.pool.close()
 
     def create_tables(self):
         conn = self.get_connection()
 
         try:
             conn.execute("create table if not exists knowledges (id INTEGER primary key, updated_at DATETIME, namespace TEXT, body TEXT, serialized_json TEXT)")
-            conn.execute("create virtual table if not exists embeddings using vss0 (body_embedding(1536))")
+            conn.execute("create index if not exists knowledges_namespace on knowledges (namespace)")
+            # Record counts per namespace, updated in the transactions that write knowledges.
+            # Count existing records once when the table is created
+            conn.execute("begin immediate")
+            if not conn.execute("select name from sqlite_master where type = 'table' and name = 'record_counts'").fetchone():
+                conn.execute("create table record_counts (namespace TEXT primary key, count INTEGER)")
+                conn.execute("insert into record_counts (namespace, count) select namespace, count(*) from knowledges group by namespace")
             conn.commit()
+            if conn.execute("select name from sqlite_master where type = 'table' and name = 'embeddings'").fetchone():
+                # vss0 index can't be changed in place. Keep the existing one
+                current_index_factory = self.get_index_factory(conn)
+                if self.index_factory and self.make_index_factory(self.index_factory) != current_index_factory:
+                    logger.warning(f"Index factory '{self.index_factory}' is ignored because the index is already created with '{current_index_factory}'. Use rebuild_index to change it.")
+                self.index_factory = current_index_factory
+            else:
+                conn.execute(f"create virtual table embeddings using vss0 ({self.make_index_column(self.index_factory)})")
+            if self.index_factory:
+                conn.execute("create table if not exists embedding_vectors (id INTEGER primary key, embedding BLOB)")
+            conn.execute("create table if not exists index_version (id INTEGER primary key, version INTEGER)")
+            conn.execute("insert or ignore into index_version (id, version) values (1, 0)")
+            self.use_vector_table(conn)
+            self.index_trained = self.is_index_trained(conn)
+            conn.execute("create table if not exists embedding_cache (key TEXT primary key, model TEXT, embedding BLOB, created_at DATETIME)")
+            conn.execute("create index if not exists embedding_cache_created_at on embedding_cache (created_at)")
+            self.persistent_embedding_cache_count = conn.execute("select count(*) from embedding_cache").fetchone()[0]
+            # Quantized codes are made in memory when matrices are loaded. Drop codes persisted by older versions
+            conn.execute("drop table if exists embedding_codes")
+            self.index_versioned = True
         
         except Exception as ex:
             logger.error(f"Error at VSSEngine.create_tables: {str(ex)}\n{traceback.format_exc()}")
@@ -47,7 +315,7 @@ class VSSLite:
             raise ex
 
         finally:
-            conn.close()
+            self.release_connection(conn)
 
     @staticmethod
     def vector_to_bytes(vector: List[float]) -> bytes:
@@ -57,21 +325,196 @@ class VSSLite:
     def bytes_to_vector(embedding: bytes) -> List[float]:
         return np.frombuffer(embedding, dtype=np.float32).tolist()
 
-    async def acreate_embedding(self, text: str) -> List[float]:
-        response = await Embedding.acreate(
-            api_key = self.openai_apikey,
-            engine="text-embedding-ada-002",
-            input=[text]
-        )
-        return response["data"][0]["embedding"]
+    @staticmethod
+    def make_index_factory(index_factory: str=None) -> str:
+        if not index_factory:
+            return None
 
-    async def aadd(self, body: str, data: dict=None, namespace: str="default") -> int:
+        # Records are deleted and updated by removing ids from the index
+        components = [c.strip() for c in index_factory.split(",")]
+        if any(re.match(r"(HNSW|NSG)", c) for c in components):
+            raise ValueError(f"Unsupported index factory: {index_factory}. HNSW and NSG indexes can't remove vectors")
+
+        # IVF indexes support ids by themselves, even behind transforms like PCA or OPQ,
+        # and removing ids through IDMap2 breaks them. Others (Flat, PQ, ...) need IDMap2 to be stored with rowid.
+        if not any(c.startswith("IVF") for c in components) and components[-1] != "IDMap2":
+            index_factory += ",IDMap2"
+        return index_factory
+
+    def make_index_column(self, index_factory: str=None) -> str:
+        if not index_factory:
+            return f"body_embedding({self.dimension})"
+        if any(c.strip().startswith("IVF") for c in index_factory.split(",")):
+            logger.warning(f"Index factory '{index_factory}' probes only one IVF list because sqlite-vss doesn't expose nprobe. Recall may be poor.")
+        return f'body_embedding({self.dimension}) factory="{self.make_index_factory(index_factory)}"'
+
+    def use_vector_table(self, conn: sqlite3.Connection):
+        # vss0 can reconstruct vectors only with the default index. Read them from the
+        # regular table instead when the index is created with a factory.
+        if self.get_index_factory(conn):
+            self.vector_table, self.vector_id_column, self.vector_column = "embedding_vectors", "id", "embedding"
+        else:
+            self.vector_table, self.vector_id_column, self.vector_column = "embeddings", "rowid", "body_embedding"
+
+    def is_index_trained(self, conn: sqlite3.Connection) -> bool:
+        if not self.index_factory:
+            return True
+
+        # Untrained indexes (IVF, PQ, ...) reject vectors. Try adding a dummy vector and discard it
+        conn.execute("begin")
+        try:
+            conn.execute("insert into embeddings (rowid, body_embedding) values (?, ?)", (-1, self.vector_to_bytes([0.0] * self.dimension)))
+            return True
+        except sqlite3.OperationalError as ex:
+            if "requires training" not in str(ex):
+                raise
+            return False
+        finally:
+            conn.rollback()
+
+    def insert_index_vectors(self, conn: sqlite3.Connection, ids: List[int], embeddings: List[List[float]]):
+        # Until the index is trained, vectors are kept only in embedding_vectors and searched exactly
+        if self.index_trained:
+            conn.executemany(
+                "insert into embeddings (rowid, body_embedding) values (?, ?)",
+                [(id, self.vector_to_bytes(e)) for id, e in zip(ids, embeddings)]
+            )
+            self.update_index_version(conn)
+
+    def insert_vectors(self, conn: sqlite3.Connection, ids: List[int], embeddings: List[List[float]]):
+        if self.vector_table == "embedding_vectors" and ids:
+            conn.executemany(
+                "insert or replace into embedding_vectors (id, embedding) values (?, ?)",
+                [(id, self.vector_to_bytes(e)) for id, e in zip(ids, embeddings)]
+            )
+
+    def delete_vectors(self, conn: sqlite3.Connection, id: int=None):
+        if self.vector_table != "embedding_vectors":
+            return
+
+        if id is None:
+            conn.execute("delete from embedding_vectors")
+        else:
+            conn.execute("delete from embedding_vectors where id = ?", (id, ))
+
+    def select_cached_embeddings(self, keys: List[str]) -> dict:
+        conn = self.get_connection()
+
+        try:
+            ret = {}
+            # Split keys to stay under the limit of host parameters
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                records = conn.execute(
+                    f"select key, embedding from embedding_cache where key in ({','.join('?' * len(chunk))})",
+                    chunk
+                ).fetchall()
+                for record in records:
+                    ret[record[0]] = np.frombuffer(record[1], dtype=np.float32)
+            return ret
+
+        finally:
+            self.release_connection(conn)
+
+    def insert_cached_embeddings(self, items: dict):
         now = datetime.utcnow()
-        embedding = await self.acreate_embedding(body)
+        conn = self.get_connection()
+
+        try:
+            conn.execute("begin")
+            conn.executemany(
+                "insert or replace into embedding_cache (key, model, embedding, created_at) values (?, ?, ?, ?)",
+                [(k, self.embedding_provider.model_name, self.vector_to_bytes(v), now) for k, v in items.items()]
+            )
+            # Counted as new even when replaced. It is corrected on eviction
+            self.persistent_embedding_cache_count += len(items)
+            if self.persistent_embedding_cache_count > self.persistent_embedding_cache_size:
+                # Evict the oldest embeddings
+                self.persistent_embedding_cache_count = conn.execute("select count(*) from embedding_cache").fetchone()[0]
+                if self.persistent_embedding_cache_count > self.persistent_embedding_cache_size:
+                    conn.execute(
+                        "delete from embedding_cache where key in (select key from embedding_cache order by created_at limit ?)",
+                        (self.persistent_embedding_cache_count - self.persistent_embedding_cache_size, )
+                    )
+                    self.persistent_embedding_cache_count = self.persistent_embedding_cache_size
+            conn.commit()
+
+        except Exception as ex:
+            logger.error(f"Error at VSSEngine.insert_cached_embeddings: {str(ex)}\n{traceback.format_exc()}")
+            conn.rollback()
+            raise ex
+
+        finally:
+            self.release_connection(conn)
+
+    async def acreate_embeddings(self, texts: List[str], persist: bool=True) -> List[np.ndarray]:
+        model_name = self.embedding_provider.model_name
+        keys = [self.embedding_cache.make_key(model_name, t) for t in texts]
+
+        found = {}
+        for k in keys:
+            if k not in found:
+                embedding = self.embedding_cache.get(k)
+                if embedding is not None:
+                    found[k] = embedding
+
+        if self.persist_embedding_cache:
+            missing_keys = list({k for k in keys if k not in found})
+            if missing_keys:
+                persisted = await self.executor.aread(self.select_cached_embeddings, missing_keys)
+                self.embedding_cache.count("persistent_hits", len(persisted))
+                for k, v in persisted.items():
+                    self.embedding_cache.put(k, v)
+                found.update(persisted)
+
+        missing = {}
+        for k, t in zip(keys, texts):
+            if k not in found and k not in missing:
+                missing[k] = t
+
+        if missing:
+            self.embedding_cache.count("misses", len(missing))
+            created = {k: np.asarray(v, dtype=np.float32) for k, v in zip(missing.keys(), await self.embedding_provider.aembed(list(missing.values())))}
+            for k, v in created.items():
+                self.embedding_cache.put(k, v)
+            if self.persist_embedding_cache and persist:
+                # Don't wait for persisting. Writes that follow still run after it on the writer
+                self.executor.write_nowait(self.insert_cached_embeddings, created)
+            found.update(created)
 
+        return [found[k] for k in keys]
+
+    async def acreate_embedding(self, text: str) -> np.ndarray:
+        return (await self.acreate_embeddings([text]))[0]
+
+    def count_tokens(self, text: str) -> int:
+        return self.embedding_provider.count_tokens(text)
+
+    def make_batches(self, texts: List[str]) -> List[List[int]]:
+        # Group indices of texts so that each batch fits in a single embedding request
+        batches = []
+        batch = []
+        batch_tokens = 0
+        for i, text in enumerate(texts):
+            tokens = self.count_tokens(text)
+            if batch and (len(batch) >= self.embedding_batch_size or batch_tokens + tokens > self.embedding_batch_tokens):
+                batches.append(batch)
+                batch = []
+                batch_tokens = 0
+            batch.append(i)
+            batch_tokens += tokens
+
+        if batch:
+            batches.append(batch)
+
+        return batches
+
+    def insert_record(self, body: str, embedding: List[float], data: dict=None, namespace: str="default") -> int:
+        now = datetime.utcnow()
         conn = self.get_connection()
 
         try:
+            conn.execute("begin")
             conn.execute(
                 "insert into knowledges (updated_at, namespace, body, serialized_json) values (?, ?, ?, ?)",
                 (now, namespace, body, json.dumps(data, ensure_ascii=False) if data else "{}")
@@ -79,12 +522,12 @@ class VSSLite:
 
             last_id = conn.execute("select last_insert_rowid()").fetchone()[0]
 
-            conn.execute(
-                "insert into embeddings (rowid, body_embedding) values (?, ?)",
-                (last_id, self.vector_to_bytes(embedding))
-            )
+            self.insert_index_vectors(conn, [last_id], [embedding])
+            self.insert_vectors(conn, [last_id], [embedding])
             
+            self.update_count(conn, namespace, 1)
             conn.commit()
+            self.update_matrix(namespace, added_ids=[last_id], added_embeddings=[embedding])
 
             return last_id
         
@@ -94,15 +537,58 @@ class VSSLite:
             raise ex
             
         finally:
-            conn.close()
+            self.release_connection(conn)
+
+    async def aadd(self, body: str, data: dict=None, namespace: str="default") -> int:
+        embedding = await self.acreate_embedding(body)
+        return await self.executor.awrite(self.insert_record, body, embedding, data, namespace)
     
     def add(self, body: str, data: dict=None, namespace: str="default") -> int:
         return self.sync(self.aadd(body, data, namespace))
 
-    async def aupdate(self, id: int, body: str, data: dict=None) -> int:
+    def insert_records(self, bodies: List[str], embeddings: List[List[float]], data_list: List[dict]=None, namespace: str="default") -> List[int]:
         now = datetime.utcnow()
-        embedding = await self.acreate_embedding(body)
+        data_list = data_list or [None] * len(bodies)
+        conn = self.get_connection()
+
+        try:
+            ids = []
+            conn.execute("begin")
+            for body, data in zip(bodies, data_list):
+                conn.execute(
+                    "insert into knowledges (updated_at, namespace, body, serialized_json) values (?, ?, ?, ?)",
+                    (now, namespace, body, json.dumps(data, ensure_ascii=False) if data else "{}")
+                )
+                ids.append(conn.execute("select last_insert_rowid()").fetchone()[0])
+            self.insert_index_vectors(conn, ids, embeddings)
+            self.insert_vectors(conn, ids, embeddings)
+
+            self.update_count(conn, namespace, len(ids))
+            conn.commit()
+            self.update_matrix(namespace, added_ids=ids, added_embeddings=embeddings)
+
+            return ids
+
+        except Exception as ex:
+            logger.error(f"Error at VSSEngine.add_many: {str(ex)}\n{traceback.format_exc()}")
+            conn.rollback()
+            raise ex
+
+        finally:
+            self.release_connection(conn)
 
+    async def aadd_many(self, bodies: List[str], data_list: List[dict]=None, namespace: str="default") -> List[int]:
+        # Embed in batches and add all records in a single transaction, that is, all or nothing
+        embeddings = []
+        for batch in self.make_batches(bodies):
+            embeddings.extend(await self.acreate_embeddings([bodies[i] for i in batch]))
+        return await self.executor.awrite(self.insert_records, bodies, embeddings, data_list, namespace)
+
+    def add_many(self, bodies: List[str], data_list: List[dict]=None, namespace: str="default") -> List[int]:
+        return self.sync(self.aadd_many(bodies, data_list, namespace))
+
+    def replace_record(self, id: int, body: str, embedding: List[float], data: dict=None) -> int:
+        now = datetime.utcnow()
         conn = self.get_connection()
 
         try:
@@ -112,19 +598,21 @@ class VSSLite:
             ).fetchone()[0]
 
             # Delete and add because virtual table doesn't support update
+            conn.execute("begin")
             conn.execute("delete from knowledges where id = ?", (id, ))
             conn.execute("delete from embeddings where rowid = ?", (id, ))
+            self.update_index_version(conn)
+            self.delete_vectors(conn, id)
             conn.execute(
                 "insert into knowledges (updated_at, namespace, body, serialized_json) values (?, ?, ?, ?)",
                 (now, current_record_namespace, body, json.dumps(data, ensure_ascii=False) if data else "{}")
             )
             last_id = conn.execute("select last_insert_rowid()").fetchone()[0]
-            conn.execute(
-                "insert into embeddings (rowid, body_embedding) values (?, ?)",
-                (last_id, self.vector_to_bytes(embedding))
-            )
+            self.insert_index_vectors(conn, [last_id], [embedding])
+            self.insert_vectors(conn, [last_id], [embedding])
 
             conn.commit()
+            self.update_matrix(current_record_namespace, removed_ids=[id], added_ids=[last_id], added_embeddings=[embedding])
 
             return last_id
         
@@ -134,18 +622,30 @@ class VSSLite:
             raise ex
 
         finally:
-            conn.close()
+            self.release_connection(conn)
+
+    async def aupdate(self, id: int, body: str, data: dict=None) -> int:
+        embedding = await self.acreate_embedding(body)
+        return await self.executor.awrite(self.replace_record, id, body, embedding, data)
 
     def update(self, id: int, body: str, data: dict=None) -> int:
         return self.sync(self.aupdate(id, body, data))
 
-    async def adelete(self, id: int):
+    def delete_record(self, id: int):
         conn = self.get_connection()
 
         try:
+            record = conn.execute("select namespace from knowledges where id = ?", (id, )).fetchone()
+            conn.execute("begin")
             conn.execute("delete from knowledges where id = ?", (id, ))
             conn.execute("delete from embeddings where rowid = ?", (id, ))
+            self.update_index_version(conn)
+            self.delete_vectors(conn, id)
+            if record:
+                self.update_count(conn, record[0], -1)
             conn.commit()
+            if record:
+                self.update_matrix(record[0], removed_ids=[id])
 
         except Exception as ex:
             logger.error(f"Error at VSSEngine.delete: {str(ex)}\n{traceback.format_exc()}")
@@ -153,18 +653,30 @@ class VSSLite:
             raise ex
 
         finally:
-            conn.close()
+            self.release_connection(conn)
+
+    async def adelete(self, id: int):
+        await self.executor.awrite(self.delete_record, id)
 
     def delete(self, id: int):
         self.sync(self.adelete(id))
 
-    async def adelete_all(self):
+    def delete_all_records(self):
         conn = self.get_connection()
 
         try:
+            conn.execute("begin")
             conn.execute("delete from knowledges")
             conn.execute("delete from embeddings")
+            self.update_index_version(conn)
+            self.delete_vectors(conn)
+            conn.execute("delete from record_counts")
             conn.commit()
+            with self.matrices_lock:
+                self.matrices.clear()
+                # Matrices being loaded may contain deleted records
+                for loading in self.loading_matrices.values():
+                    loading["discarded"] = True
 
         except Exception as ex:
             logger.error(f"Error at VSSEngine.delete_all: {str(ex)}\n{traceback.format_exc()}")
@@ -172,19 +684,22 @@ class VSSLite:
             raise ex
 
         finally:
-            conn.close()
+            self.release_connection(conn)
+
+    async def adelete_all(self):
+        await self.executor.awrite(self.delete_all_records)
 
     def delete_all(self):
         self.sync(self.adelete_all())
 
-    async def aget(self, id: int) -> dict:
-        conn = self.get_connection()
+    def select_record(self, id: int) -> dict:
+        conn = self.get_connection(read=True)
 
         try:
-            record = conn.execute("""
-                select knowledges.id, knowledges.updated_at, knowledges.namespace, knowledges.body, knowledges.serialized_json, embeddings.body_embedding
+            record = conn.execute(f"""
+                select knowledges.id, knowledges.updated_at, knowledges.namespace, knowledges.body, knowledges.serialized_json, {self.vector_table}.{self.vector_column}
                 from knowledges
-                join embeddings on knowledges.id = embeddings.rowid
+                join {self.vector_table} on knowledges.id = {self.vector_table}.{self.vector_id_column}
                 where knowledges.id = ?
             """,
             (id, )
@@ -205,74 +720,363 @@ class VSSLite:
             raise ex
         
         finally:
-            conn.close()
+            self.release_connection(conn)
+
+    async def aget(self, id: int) -> dict:
+        return await self.executor.aread(self.select_record, id)
 
     def get(self, id: int) -> dict:
         return self.sync(self.aget(id))
 
-    async def asearch(self, query: str, count: int=1, namespace: str="default") -> List[dict]:
-        query_embedding = await self.acreate_embedding(query)
+    def load_matrix(self, conn: sqlite3.Connection, namespace: str) -> VectorMatrix:
+        count = conn.execute("select count(*) from knowledges where namespace = ?", (namespace, )).fetchone()[0]
+        # Quantize page by page so that float32 vectors of the namespace are not held all at once
+        matrix = VectorMatrix(self.dimension, count, self.quantization or "float32")
+        for records in self.iter_vector_pages(conn, self.vector_table, self.vector_id_column, self.vector_column, namespace):
+            matrix.add(
+                [r[0] for r in records],
+                np.frombuffer(b"".join(r[1] for r in records), dtype=np.float32)
+            )
 
-        conn = self.get_connection()
+        return matrix
+
+    def get_matrix(self, conn: sqlite3.Connection, namespace: str) -> VectorMatrix:
+        with self.matrices_lock:
+            matrix = self.matrices.get(namespace)
+            if matrix is not None:
+                self.matrices.move_to_end(namespace)
+                return matrix
+            loading = self.loading_matrices.get(namespace)
+            if loading is None:
+                # Writes committed while loading are recorded to be applied to the loaded matrix
+                loading = {"done": threading.Event(), "writes": [], "matrix": None, "discarded": False}
+                self.loading_matrices[namespace] = loading
+                is_loader = True
+            else:
+                is_loader = False
+
+        if not is_loader:
+            # Wait for another reader loading the same namespace
+            loading["done"].wait()
+            if loading["matrix"] is None:
+                return self.get_matrix(conn, namespace)
+            return loading["matrix"]
 
         try:
-            records = conn.execute("""
-                select knowledges.id, knowledges.updated_at, knowledges.namespace, knowledges.body, knowledges.serialized_json, embeddings.distance
+            # Load without matrices_lock not to block searches and writes of other namespaces
+            matrix = self.load_matrix(conn, namespace)
+            with self.matrices_lock:
+                # Adding the same id twice just replaces it, so writes already loaded can be applied again
+                for removed_ids, added_ids, added_embeddings in loading["writes"]:
+                    if removed_ids:
+                        matrix.remove(removed_ids)
+                    if added_ids:
+                        matrix.add(added_ids, added_embeddings)
+                if not loading["discarded"] and (len(matrix) <= self.exact_search_threshold or not self.index_trained):
+                    self.matrices[namespace] = matrix
+                    self.evict_matrices(namespace)
+                loading["matrix"] = matrix
+            return matrix
+
+        finally:
+            with self.matrices_lock:
+                del self.loading_matrices[namespace]
+            loading["done"].set()
+
+    def evict_matrices(self, namespace: str):
+        # Call with matrices_lock. The matrix of the namespace is kept even if it alone is over the limit
+        total_bytes = sum(m.nbytes for m in self.matrices.values())
+        for ns in list(self.matrices):
+            if total_bytes <= self.max_matrix_bytes:
+                break
+            if ns != namespace:
+                total_bytes -= self.matrices.pop(ns).nbytes
+
+    def rerank(self, conn: sqlite3.Connection, query_embeddings: List[List[float]], hits_list: List[List[tuple]], count: int) -> List[List[tuple]]:
+        # Recalculate exact distances of candidates with float32 vectors
+        ids = list({h[0] for hits in hits_list for h in hits})
+        vectors = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            for r in conn.execute(
+                f"select {self.vector_id_column}, {self.vector_column} from {self.vector_table} where {self.vector_id_column} in ({','.join('?' * len(chunk))})",
+                chunk
+            ).fetchall():
+                vectors[r[0]] = np.frombuffer(r[1], dtype=np.float32)
+
+        ret = []
+        for query_embedding, hits in zip(query_embeddings, hits_list):
+            q = np.asarray(query_embedding, dtype=np.float32)
+            reranked = []
+            for id, _ in hits:
+                if id in vectors:
+                    d = vectors[id] - q
+                    reranked.append((id, float(d @ d)))
+            reranked.sort(key=lambda h: h[1])
+            ret.append(reranked[:count])
+
+        return ret
+
+    def update_matrix(self, namespace: str, removed_ids: List[int]=None, added_ids: List[int]=None, added_embeddings: List[List[float]]=None):
+        with self.matrices_lock:
+            loading = self.loading_matrices.get(namespace)
+            if loading is not None:
+                loading["writes"].append((removed_ids, added_ids, added_embeddings))
+            matrix = self.matrices.get(namespace)
+            if matrix is None:
+                return
+            if removed_ids:
+                matrix.remove(removed_ids)
+            if added_ids:
+                matrix.add(added_ids, added_embeddings)
+            if len(matrix) > self.exact_search_threshold and self.index_trained:
+                # Too large to search by brute force. Release memory and use vss0
+                del self.matrices[namespace]
+            elif added_ids:
+                self.evict_matrices(namespace)
+
+    def select_knowledges(self, conn: sqlite3.Connection, hits_list: List[List[tuple]]) -> List[List[dict]]:
+        # Select records for all queries at once
+        ids = list({h[0] for hits in hits_list for h in hits})
+        records = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            for r in conn.execute(
+                f"select id, updated_at, namespace, body, serialized_json from knowledges where id in ({','.join('?' * len(chunk))})",
+                chunk
+            ).fetchall():
+                records[r[0]] = r
+
+        ret = []
+        for hits in hits_list:
+            results = []
+            for id, distance in hits:
+                record = records.get(id)
+                if record:
+                    results.append({
+                        "id": record[0],
+                        "updated_at": record[1],
+                        "namespace": record[2],
+                        "body": record[3],
+                        "data": json.loads(record[4]),
+                        "distance": distance
+                    })
+            ret.append(results)
+
+        return ret
+
+    def search_vss(self, conn: sqlite3.Connection, query_embedding: List[float], count: int, namespace: str, namespace_count: int, total_count: int) -> List[tuple]:
+        count = min(count, namespace_count)
+
+        # vss0 can't filter by namespace inside the index, so fetch enough neighbors
+        # to contain `count` records of the namespace, estimated by its share of all records.
+        # Double it until satisfied because records of the namespace may be farther than others.
+        k = min(total_count, int(count * total_count / namespace_count * self.namespace_overfetch) + 1)
+        while True:
+            hits = conn.execute("""
+                select knowledges.id, embeddings.distance
                 from knowledges
                 join embeddings on knowledges.id = embeddings.rowid
-                where vss_search(embeddings.body_embedding, vss_search_params(?, 10)) and knowledges.namespace = ?
+                where vss_search(embeddings.body_embedding, vss_search_params(?, ?)) and knowledges.namespace = ?
                 order by embeddings.distance
                 limit ?""",
-            (self.vector_to_bytes(query_embedding), namespace, count)
+            (self.vector_to_bytes(query_embedding), k, namespace, count)
             ).fetchall()
 
-            ret = []
-            for record in records:
-                ret.append({
-                    "id": record[0],
-                    "updated_at": record[1],
-                    "namespace": record[2],
-                    "body": record[3],
-                    "data": json.loads(record[4]),
-                    "distance": record[5]
-                })
+            if len(hits) >= count or k >= total_count:
+                return hits
+            k = min(total_count, k * 2)
 
-            return ret
+    def search_records(self, query_embeddings: List[List[float]], count: int=1, namespace: str="default") -> List[List[dict]]:
+        conn = self.get_connection(read=True)
+
+        try:
+            # Use stored counts not to count records on every search
+            namespace_count, total_count = self.select_counts(conn, namespace)
+            if namespace_count == 0:
+                return [[] for _ in query_embeddings]
+
+            if namespace_count <= self.exact_search_threshold or not self.index_trained:
+                if self.quantization:
+                    hits_list = self.get_matrix(conn, namespace).search(query_embeddings, count * self.rerank_factor)
+                    hits_list = self.rerank(conn, query_embeddings, hits_list, count)
+                else:
+                    hits_list = self.get_matrix(conn, namespace).search(query_embeddings, count)
+            elif self.vector_table == "embedding_vectors":
+                # Distances of compressed vectors (PQ, ...) are approximate. Fetch more candidates and
+                # rerank them with exact distances. This doesn't help IVF, which searches only one list
+                hits_list = [self.search_vss(conn, q, count * self.rerank_factor, namespace, namespace_count, total_count) for q in query_embeddings]
+                hits_list = self.rerank(conn, query_embeddings, hits_list, count)
+            else:
+                hits_list = [self.search_vss(conn, q, count, namespace, namespace_count, total_count) for q in query_embeddings]
+
+            return self.select_knowledges(conn, hits_list)
 
         except Exception as ex:
             logger.error(f"Error at VSSEngine.search: {str(ex)}\n{traceback.format_exc()}")
             raise ex
         
         finally:
-            conn.close()
+            self.release_connection(conn)
+
+    async def asearch(self, query: str, count: int=1, namespace: str="default") -> List[dict]:
+        return (await self.asearch_many([query], count, namespace))[0]
 
     def search(self, query: str, count: int=1, namespace: str="default") -> List[dict]:
         return self.sync(self.asearch(query, count, namespace))
 
+    async def asearch_many(self, queries: List[str], count: int=1, namespace: str="default") -> List[List[dict]]:
+        if not queries:
+            return []
+        query_embeddings = await self.acreate_embeddings(queries, persist=self.persist_query_embeddings)
+        return await self.executor.aread(self.search_records, query_embeddings, count, namespace)
+
+    def search_many(self, queries: List[str], count: int=1, namespace: str="default") -> List[List[dict]]:
+        return self.sync(self.asearch_many(queries, count, namespace))
+
+    def get_index_factory(self, conn: sqlite3.Connection) -> str:
+        sql = conn.execute("select sql from sqlite_master where name = 'embeddings'").fetchone()[0]
+        m = re.search(r'factory\s*=\s*"([^"]*)"', sql)
+        return m.group(1) if m else None
+
+    def iter_vector_pages(self, conn: sqlite3.Connection, table: str, id_column: str, column: str, namespace: str=None):
+        # Read vectors of records page by page by id not to load all of them at once
+        last_id = 0
+        while True:
+            records = conn.execute(f"""
+                select knowledges.id, {table}.{column}
+                from knowledges
+                join {table} on knowledges.id = {table}.{id_column}
+                where knowledges.id > ? and (? is null or knowledges.namespace = ?)
+                order by knowledges.id
+                limit ?""",
+            (last_id, namespace, namespace, self.vector_page_size)
+            ).fetchall()
+            if not records:
+                return
+            yield records
+            last_id = records[-1][0]
+
+    def rebuild_index_table(self, index_factory: str=None, sample_size: int=None) -> dict:
+        conn = self.get_connection()
+
+        try:
+            index_factory = index_factory or self.get_index_factory(conn)
+            index_column = self.make_index_column(index_factory)
+
+            # Keep vectors in the regular table first so that they survive rebuilding
+            conn.execute("begin")
+            conn.execute("create table if not exists embedding_vectors (id INTEGER primary key, embedding BLOB)")
+            if self.vector_table != "embedding_vectors":
+                # Vectors left by a previous factory may be stale
+                conn.execute("delete from embedding_vectors")
+                for records in self.iter_vector_pages(conn, "embeddings", "rowid", "body_embedding"):
+                    conn.executemany("insert into embedding_vectors (id, embedding) values (?, ?)", records)
+            conn.commit()
+
+            conn.execute("begin")
+            conn.execute("drop table if exists embeddings")
+            conn.execute(f"create virtual table embeddings using vss0 ({index_column})")
+            self.update_index_version(conn)
+            conn.commit()
+            self.use_vector_table(conn)
+
+            # Train with sampled vectors. vss0 keeps them in memory and trains the index on commit
+            trained_count = 0
+            if index_factory:
+                sample_ids = None
+                if sample_size:
+                    sample_ids = {r[0] for r in conn.execute("select id from embedding_vectors order by random() limit ?", (sample_size, ))}
+                conn.execute("begin")
+                for records in self.iter_vector_pages(conn, "embedding_vectors", "id", "embedding"):
+                    samples = [(r[1], ) for r in records if sample_ids is None or r[0] in sample_ids]
+                    conn.executemany("insert into embeddings (operation, body_embedding) values ('training', ?)", samples)
+                    trained_count += len(samples)
+                conn.commit()
+
+            self.index_factory = index_factory
+            self.index_trained = self.is_index_trained(conn)
+            indexed_count = 0
+            if self.index_trained:
+                # Commit page by page because vss0 holds added vectors in memory until commit
+                for records in self.iter_vector_pages(conn, "embedding_vectors", "id", "embedding"):
+                    conn.execute("begin")
+                    conn.executemany("insert into embeddings (rowid, body_embedding) values (?, ?)", records)
+                    self.update_index_version(conn)
+                    conn.commit()
+                    indexed_count += len(records)
+            else:
+                indexed_count = conn.execute("select count(*) from knowledges join embedding_vectors on knowledges.id = embedding_vectors.id").fetchone()[0]
+
+            return {"index_factory": index_factory, "trained_count": trained_count, "indexed_count": indexed_count}
+
+        except Exception as ex:
+            logger.error(f"Error at VSSEngine.rebuild_index: {str(ex)}\n{traceback.format_exc()}")
+            conn.rollback()
+            raise ex
+
+        finally:
+            self.release_connection(conn)
+
+    async def arebuild_index(self, index_factory: str=None, sample_size: int=None) -> dict:
+        # Recreate vss0 index with the factory (current one if None), train it with sampled vectors and add all vectors
+        return await self.executor.awrite(self.rebuild_index_table, index_factory, sample_size)
+
+    def rebuild_index(self, index_factory: str=None, sample_size: int=None) -> dict:
+        return self.sync(self.arebuild_index(index_factory, sample_size))
+
+    async def atrain_index(self, sample_size: int=None) -> dict:
+        # Trained indexes can't be re-trained with existing vectors in place, so rebuild with the current factory
+        return await self.arebuild_index(None, sample_size)
+
+    def train_index(self, sample_size: int=None) -> dict:
+        return self.sync(self.atrain_index(sample_size))
+
     async def aload_records_as_json(self, path) -> List[dict]:
-        async with aiofiles.open(path, mode="r", newline="") as file:
-            content = await file.read()
-            try:
-                return json.loads(content)["records"]
-            except Exception as ex:
-                csv_lines = content.split("\n")
-                reader = csv.DictReader(csv_lines)
-                return [dict(r) for r in reader]
+        return [r async for r in aiter_records(path)]
 
     async def aimport_file(self, path: str, body_key: str="body", namespace: str="default"):
-        records = await self.aload_records_as_json(path)
-
         ret = {"ids": [], "errors": []}
-        for r in records:
-            try:
-                if "id" in r:
+        pending = []
+        async for r in aiter_records(path):
+            if "id" in r:
+                # Flush added records first to keep ids in the order of the file
+                await self.aimport_records(pending, body_key, namespace, ret)
+                pending = []
+                try:
                     ret["ids"].append(await self.aupdate(r["id"], r[body_key], r))
-                else:
-                    ret["ids"].append(await self.aadd(r[body_key], r, namespace))
-            except Exception as ex:
-                ret["errors"].append({"message": str(ex), "record": r})
+                except Exception as ex:
+                    ret["errors"].append({"message": str(ex), "record": r})
+            else:
+                pending.append(r)
+                if len(pending) >= self.embedding_batch_size:
+                    await self.aimport_records(pending, body_key, namespace, ret)
+                    pending = []
+
+        await self.aimport_records(pending, body_key, namespace, ret)
 
         return ret
 
+    async def aimport_records(self, records: List[dict], body_key: str, namespace: str, ret: dict):
+        valid_records = []
+        for r in records:
+            if body_key in r:
+                valid_records.append(r)
+            else:
+                ret["errors"].append({"message": f"'{body_key}' not found", "record": r})
+
+        bodies = [r[body_key] for r in valid_records]
+        for batch in self.make_batches(bodies):
+            batch_records = [valid_records[i] for i in batch]
+            try:
+                ret["ids"].extend(await self.aadd_many([bodies[i] for i in batch], batch_records, namespace))
+            except Exception:
+                # Retry one by one to report which records failed
+                for r in batch_records:
+                    try:
+                        ret["ids"].append(await self.aadd(r[body_key], r, namespace))
+                    except Exception as ex:
+                        ret["errors"].append({"message": str(ex), "record": r})
+
     def import_file(self, path: str, body_key: str="body", namespace: str="default"):
         return self.sync(self.aimport_file(path, body_key, namespace))